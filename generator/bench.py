@@ -0,0 +1,246 @@
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import chess
+import chess.pgn
+from chess import Board, Move
+from typing import Any, Dict, List, Optional
+import generator
+from reader import open_file, is_game_start
+
+bench_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench")
+# a fixed slice of eval annotated games of a lichess database dump, see slice_corpus
+lichess_corpus_path = os.path.join(bench_dir, "lichess.pgn.zst")
+# synthetic games, only used without the lichess slice
+synthetic_corpus_path = os.path.join(bench_dir, "corpus.pgn.zst")
+
+def default_corpus() -> str:
+    return lichess_corpus_path if os.path.exists(lichess_corpus_path) else synthetic_corpus_path
+
+def slice_corpus(source: str, path: str, count: int, skip: int) -> int:
+    """
+    Copies `count` eval annotated games of a lichess database dump, the first ones after skipping
+    `skip` games of the dump, as they are. Most of them are rejected by the prescreen like in
+    production, so every stage is measured on the mix of games the generator really goes through.
+    Returns the count of games copied, fewer if the dump ends first.
+    """
+    import zstandard
+    copied, games = 0, 0
+    game: List[str] = []
+    def flush() -> None:
+        nonlocal copied
+        if games > skip and copied < count and any("%eval" in line for line in game):
+            out.write("".join(game).encode())
+            copied += 1
+    with open_file(source) as lines, zstandard.ZstdCompressor().stream_writer(open(path, "wb")) as out:
+        for line in lines:
+            if is_game_start(line):
+                flush()
+                if copied >= count:
+                    break
+                games, game = games + 1, []
+            game.append(line)
+        else:
+            flush()
+    return copied
+
+values = { chess.PAWN: 100, chess.KNIGHT: 300, chess.BISHOP: 300, chess.ROOK: 500, chess.QUEEN: 900, chess.KING: 0 }
+
+def material(board: Board) -> int:
+    return sum(values[piece.piece_type] * (1 if piece.color == board.turn else -1) for piece in board.piece_map().values())
+
+# what the side to move wins with its best capture, if the captured piece isn't defended
+def capture_gain(board: Board) -> int:
+    gains = [0]
+    for move in board.generate_legal_captures():
+        captured = board.piece_at(move.to_square)
+        gain = values[captured.piece_type] if captured else values[chess.PAWN]
+        if board.is_attacked_by(not board.turn, move.to_square):
+            gain -= values[board.piece_type_at(move.from_square) or chess.PAWN]
+        gains.append(gain)
+    return max(gains)
+
+# a mate in 1 or 2 starting with a check, the ones a careless player misses
+def short_mate(board: Board) -> Optional[int]:
+    for move in board.legal_moves:
+        board.push(move)
+        try:
+            if board.is_checkmate():
+                return 1
+        finally:
+            board.pop()
+    for move in board.legal_moves:
+        if not board.gives_check(move):
+            continue
+        board.push(move)
+        replies = list(board.legal_moves)
+        mated = bool(replies)
+        for reply in replies:
+            board.push(reply)
+            mated = mated and any(board.gives_check(m) and is_mate(board, m) for m in board.legal_moves)
+            board.pop()
+            if not mated:
+                break
+        board.pop()
+        if mated:
+            return 2
+    return None
+
+def is_mate(board: Board, move: Move) -> bool:
+    board.push(move)
+    mate = board.is_checkmate()
+    board.pop()
+    return mate
+
+# a rough eval from white's point of view, in the %eval format
+def rough_eval(board: Board) -> str:
+    mate = short_mate(board)
+    sign = 1 if board.turn == chess.WHITE else -1
+    if mate is not None:
+        return "#{}".format(mate * sign)
+    return "{:.2f}".format(sign * (material(board) + capture_gain(board)) / 100)
+
+def play(rng: random.Random, board: Board) -> Move:
+    moves = list(board.legal_moves)
+    mating = [move for move in moves if is_mate(board, move)]
+    if mating:
+        return mating[0]
+    # sometimes careless, else greedy for material
+    if rng.random() < 0.3:
+        return rng.choice(moves)
+    def score(move: Move) -> int:
+        board.push(move)
+        s = -material(board) - capture_gain(board)
+        board.pop()
+        return s
+    best = max(score(move) for move in moves)
+    return rng.choice([move for move in moves if score(move) == best])
+
+def make_corpus(path: str, count: int, seed: int) -> None:
+    """
+    Fallback corpus for machines without a lichess dump to slice_corpus from.
+    Games between two careless material-greedy players, with rough evals in place of engine evals.
+    They are only meant to go through the whole pipeline the same way on every run:
+    their evals have the swings, hanging pieces and short mates the prescreen looks for,
+    and the engine then decides which of those make puzzles.
+    Most of them pass the prescreen, unlike real games, so their prescreen, parse and candidate
+    rates are not comparable to production ones.
+    """
+    import zstandard
+    rng = random.Random(seed)
+    with zstandard.ZstdCompressor().stream_writer(open(path, "wb")) as f:
+        for i in range(count):
+            game = chess.pgn.Game({
+                "Event": "Rated Rapid game",
+                "Site": "https://lichess.org/" + "".join(rng.choice("0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ") for _ in range(8)),
+                "White": "bench", "Black": "bench",
+                "WhiteElo": "2000", "BlackElo": "2000",
+                "TimeControl": "600+0",
+            })
+            node: chess.pgn.GameNode = game
+            board = game.board()
+            while not board.is_game_over() and board.ply() < 120:
+                move = play(rng, board)
+                board.push(move)
+                node = node.add_main_variation(move)
+                if not board.is_game_over():
+                    node.comment = "[%eval {}]".format(rough_eval(board))
+            game.headers["Result"] = board.result()
+            f.write((game.accept(chess.pgn.StringExporter(columns = None)) + "\n\n").encode())
+
+def run(engine: str, nodes: int, workers: int, corpus: str, cassette: List[str] = []) -> Dict[str, Any]:
+    with tempfile.TemporaryDirectory() as tmp:
+        metrics_path = os.path.join(tmp, "metrics.json")
+        argv = ["-f", corpus, "-e", engine, "-t", "1", "--clear-hash", "--nodes", str(nodes),
+                "--workers", str(workers), "--out", os.path.join(tmp, "puzzles.ndjson"),
+                "--checkpoint", os.path.join(tmp, "checkpoint"), "--metrics", metrics_path] + cassette
+        start = time.monotonic()
+        generator.main(argv)
+        wall = time.monotonic() - start
+        with open(metrics_path) as f:
+            exported = json.load(f)
+    counters, timings = exported["counters"], exported["timings"]
+    def seconds(name: str) -> float:
+        return timings[name]["sum"] if name in timings else counters.get(name + "_seconds", 0)
+    def rate(count: float, seconds: float) -> float:
+        return count / seconds if seconds else 0
+    games, candidates, puzzles = counters.get("games", 0), counters.get("analyzed_games", 0), counters.get("puzzles", 0)
+    return {
+        "corpus": os.path.basename(corpus),
+        "nodes": nodes,
+        "workers": workers,
+        "games": games,
+        "candidates": candidates,
+        "puzzles": puzzles,
+        "wall_seconds": wall,
+        "rates": {
+            "games/s": rate(games, wall),
+            "candidates/s": rate(candidates, wall),
+            "puzzles/s": rate(puzzles, wall),
+        },
+        # each stage's own throughput, over the time it took
+        "stages": {
+            "decompress MB/s": rate(counters.get("decompressed_bytes", 0) / 1e6, seconds("decompress")),
+            "scan games/s": rate(games, seconds("scan")),
+            "prescreen games/s": rate(counters.get("prescreened_games", 0), seconds("prescreen")),
+            "parse candidates/s": rate(candidates, seconds("parse")),
+            "analysis candidates/s": rate(candidates, seconds("analysis")),
+            "engine nodes/s": rate(counters.get("engine_nodes", 0), seconds("engine")),
+            "engine puzzles/s": rate(puzzles, seconds("engine")),
+        },
+    }
+
+def report(result: Dict[str, Any], baseline: Optional[Dict[str, Any]]) -> None:
+    print("{} games, {} candidates, {} puzzles in {:.1f}s".format(result["games"], result["candidates"], result["puzzles"], result["wall_seconds"]))
+    for group in ["rates", "stages"]:
+        for name, value in result[group].items():
+            line = "{:>24} {:>14.2f}".format(name, value)
+            if baseline and baseline[group].get(name):
+                line += " {:>+8.1f}%".format(100 * (value / baseline[group][name] - 1))
+            print(line)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='bench.py', description='runs generator.py over a fixed corpus with a fixed node count, and reports its throughput')
+    parser.add_argument("--engine", "-e", help="analysis engine", default="stockfish")
+    parser.add_argument("--nodes", help="nodes of every search", type=int, default=200_000)
+    parser.add_argument("--workers", "-w", help="count of workers", type=int, default=1)
+    parser.add_argument("--corpus", help="eval annotated PGN. Defaults to bench/lichess.pgn.zst, or to the synthetic bench/corpus.pgn.zst without it", metavar="FILE.pgn")
+    parser.add_argument("--record", help="also write the engine searches to a cassette", metavar="FILE.json")
+    parser.add_argument("--replay", help="replay the engine searches of a cassette, to measure everything but the engine", metavar="FILE.json")
+    parser.add_argument("--save", help="write the results, to --compare later runs with", metavar="FILE.json")
+    parser.add_argument("--compare", help="results of an earlier run. Exits with 1 if the puzzle count differs", metavar="FILE.json")
+    parser.add_argument("--slice", help="write --games eval annotated games of this lichess dump to --corpus (bench/lichess.pgn.zst by default) instead", metavar="FILE.pgn.zst")
+    parser.add_argument("--games", help="count of games of --slice and --make-corpus", type=int, default=5000)
+    parser.add_argument("--skip", help="games of the dump to skip before --slice", type=int, default=0)
+    parser.add_argument("--make-corpus", help="write --games synthetic games to --corpus (bench/corpus.pgn.zst by default) instead", action="store_true")
+    parser.add_argument("--seed", help="seed of --make-corpus", type=int, default=1)
+    args = parser.parse_args()
+    if args.slice:
+        copied = slice_corpus(args.slice, args.corpus or lichess_corpus_path, args.games, args.skip)
+        print("Copied {} games".format(copied))
+        sys.exit(0)
+    if args.make_corpus:
+        make_corpus(args.corpus or synthetic_corpus_path, args.games, args.seed)
+        sys.exit(0)
+    args.corpus = args.corpus or default_corpus()
+    if args.corpus == synthetic_corpus_path:
+        print("Synthetic corpus: the prescreen, parse and candidate rates don't compare to real games, see --slice")
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    cassette = ["--record", args.record] if args.record else ["--replay", args.replay] if args.replay else []
+    result = run(args.engine, args.nodes, args.workers, args.corpus, cassette)
+    report(result, baseline)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(result, f, indent = 2)
+    if baseline and baseline.get("corpus") != result["corpus"]:
+        print("Compared with a run over another corpus: {}".format(baseline.get("corpus")))
+    elif baseline and baseline["nodes"] == result["nodes"] and baseline["puzzles"] != result["puzzles"]:
+        print("Puzzle count changed: {} -> {}".format(baseline["puzzles"], result["puzzles"]))
+        sys.exit(1)
@@ -0,0 +1,76 @@
+import json
+import sqlite3
+import chess
+import chess.engine
+import chess.polyglot
+from chess import Move, Board
+from chess.engine import Score, Mate, Cp
+from typing import Any, List, Optional, Tuple
+
+class AnalysisCache:
+    """
+    Engine results of util.get_next_move_pair, stored in sqlite so that a position is only
+    searched once across runs. Keyed by position hash, multipv, limit and engine name,
+    plus a tag for searches which don't run to the limit.
+    Scores are stored relative to the side to move.
+    """
+
+    def __init__(self, path: str, engine_name: str) -> None:
+        self.engine_name = engine_name
+        # several worker processes may share the file. A connection is only used by the worker
+        # which opened it, but closed by the main thread on exit when workers are threads.
+        self.db = sqlite3.connect(path, timeout = 60, check_same_thread = False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS analysis (
+            hash INTEGER, multipv INTEGER, limits TEXT, engine TEXT, result TEXT,
+            PRIMARY KEY (hash, multipv, limits, engine))""")
+        self.db.commit()
+
+    def _key(self, board: Board, multipv: int, limit: chess.engine.Limit, tag: str) -> Tuple[int, int, str, str]:
+        # sqlite integers are signed
+        hash = chess.polyglot.zobrist_hash(board)
+        return (hash - (1 << 64) if hash >= (1 << 63) else hash, multipv, repr(limit) + tag, self.engine_name)
+
+    def get(self, board: Board, multipv: int, limit: chess.engine.Limit, tag: str = "") -> Optional[List[Tuple[Move, Score]]]:
+        row = self.db.execute(
+            "SELECT result FROM analysis WHERE hash = ? AND multipv = ? AND limits = ? AND engine = ?",
+            self._key(board, multipv, limit, tag)).fetchone()
+        if row is None:
+            return None
+        return [(Move.from_uci(uci), Mate(mate) if mate is not None else Cp(cp)) for uci, cp, mate in json.loads(row[0])]
+
+    def put(self, board: Board, multipv: int, limit: chess.engine.Limit, lines: List[Tuple[Move, Score]], tag: str = "") -> None:
+        result = json.dumps([(move.uci(), score.score(), score.mate()) for move, score in lines])
+        self.db.execute("INSERT OR REPLACE INTO analysis VALUES (?, ?, ?, ?, ?)", self._key(board, multipv, limit, tag) + (result,))
+        self.db.commit()
+
+    # engines whose results are stored
+    def engines(self) -> List[str]:
+        return [name for name, in self.db.execute("SELECT DISTINCT engine FROM analysis")]
+
+    def close(self) -> None:
+        self.db.close()
+
+class CacheMiss(Exception):
+    pass
+
+class CacheOnlyEngine:
+    """
+    Stands for a SimpleEngine when searches may only come from the cache,
+    named like the engine which filled it. Searching raises CacheMiss.
+    """
+
+    def __init__(self, name: str) -> None:
+        self.id = {"name": name}
+
+    def analyse(self, board: Board, *args: Any, **kwargs: Any) -> Any:
+        raise CacheMiss(board.fen())
+
+    def analysis(self, board: Board, *args: Any, **kwargs: Any) -> Any:
+        raise CacheMiss(board.fen())
+
+    def configure(self, options: Any) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
@@ -0,0 +1,92 @@
+import json
+import chess
+import chess.engine
+from chess import Board, Move
+from chess.engine import SimpleEngine, Cp, Mate, PovScore, InfoDict
+from typing import Any, Dict, Iterable, List, Optional, Union
+
+# what the generator reads from search results
+recorded_keys = ["depth", "nodes", "multipv"]
+
+def key(board: Board, limit: chess.engine.Limit, multipv: Optional[int], root_moves: Optional[Iterable[Move]]) -> str:
+    roots = " ".join(sorted(move.uci() for move in root_moves)) if root_moves is not None else ""
+    return "{} {} {!r} {}".format(board.fen(), multipv, limit, roots)
+
+def dump_info(info: InfoDict) -> Dict[str, Any]:
+    score = info["score"].relative
+    dumped = { "pv": [move.uci() for move in info.get("pv", [])], "cp": score.score(), "mate": score.mate() }
+    dumped.update({ k: info[k] for k in recorded_keys if k in info })
+    return dumped
+
+def load_info(board: Board, dumped: Dict[str, Any]) -> InfoDict:
+    score = Mate(dumped["mate"]) if dumped["mate"] is not None else Cp(dumped["cp"])
+    info: InfoDict = { "pv": [Move.from_uci(uci) for uci in dumped["pv"]], "score": PovScore(score, board.turn) }
+    info.update({ k: dumped[k] for k in recorded_keys if k in dumped }) # type: ignore
+    return info
+
+class CassetteMiss(Exception):
+    pass
+
+class ReplayEngine:
+    """
+    Stands for a SimpleEngine, answering `analyse` from the searches of a cassette,
+    recorded by RecordingEngine, by position, limit, multipv and root moves.
+    Searches which were never recorded raise CassetteMiss.
+    Streamed analysis, used by --early-stop, isn't recorded.
+    """
+
+    def __init__(self, path: str) -> None:
+        with open(path) as f:
+            cassette = json.load(f)
+        self.id: Dict[str, str] = cassette["id"]
+        self.searches: Dict[str, List[Dict[str, Any]]] = cassette["searches"]
+
+    def analyse(self, board: Board, limit: chess.engine.Limit, *, multipv: Optional[int] = None, root_moves: Optional[Iterable[Move]] = None, **kwargs: Any) -> Union[InfoDict, List[InfoDict]]:
+        k = key(board, limit, multipv, root_moves)
+        if k not in self.searches:
+            raise CassetteMiss(k)
+        infos = [load_info(board, dumped) for dumped in self.searches[k]]
+        return infos if multipv is not None else infos[0]
+
+    def configure(self, options: Dict[str, Any]) -> None:
+        pass
+
+    def analysis(self, *args: Any, **kwargs: Any) -> Any:
+        raise CassetteMiss("streamed analysis isn't recorded")
+
+    def close(self) -> None:
+        pass
+
+class RecordingEngine:
+    """
+    Passes searches on to `engine`, and keeps their results to write them to the cassette
+    at `path` on close, adding to the searches already there.
+    """
+
+    def __init__(self, engine: SimpleEngine, path: str) -> None:
+        self.engine = engine
+        self.path = path
+        self.id = engine.id
+        try:
+            with open(path) as f:
+                self.searches: Dict[str, List[Dict[str, Any]]] = json.load(f)["searches"]
+        except FileNotFoundError:
+            self.searches = {}
+
+    def analyse(self, board: Board, limit: chess.engine.Limit, *, multipv: Optional[int] = None, root_moves: Optional[Iterable[Move]] = None, **kwargs: Any) -> Union[InfoDict, List[InfoDict]]:
+        root_moves = list(root_moves) if root_moves is not None else None
+        result = self.engine.analyse(board, limit, multipv = multipv, root_moves = root_moves, **kwargs)
+        infos = result if isinstance(result, list) else [result]
+        self.searches[key(board, limit, multipv, root_moves)] = [dump_info(info) for info in infos]
+        return result
+
+    def configure(self, options: Dict[str, Any]) -> None:
+        self.engine.configure(options)
+
+    def analysis(self, *args: Any, **kwargs: Any) -> Any:
+        return self.engine.analysis(*args, **kwargs)
+
+    def close(self) -> None:
+        with open(self.path, "w") as f:
+            json.dump({ "id": dict(self.id), "searches": self.searches }, f, indent = 0, sort_keys = True)
+        self.engine.close()
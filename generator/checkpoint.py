@@ -0,0 +1,65 @@
+import json
+import os
+import time
+from dataclasses import dataclass, asdict
+from threading import Lock
+from typing import Dict, Optional, Tuple
+
+@dataclass
+class Progress:
+    file: str
+    offset: int # position of the first game not fully analyzed, in the decompressed input
+    games: int # count of games before that offset
+    puzzles: int
+
+class Checkpoint:
+    """
+    Progress through the input file, saved every `interval` seconds.
+    Games are analyzed out of order by the workers, so the saved offset is the one of the
+    earliest game still being analyzed, and resuming from it never loses a game.
+    """
+
+    def __init__(self, path: str, progress: Progress, interval: float = 60) -> None:
+        self.path = path
+        self.progress = progress
+        self.interval = interval
+        self.saved_at = time.monotonic()
+        self.current = (progress.offset, progress.games)
+        self.pending: Dict[int, Tuple[int, int]] = {}
+        self.lock = Lock()
+
+    # a game starts at `offset` in the input, after `games` other games
+    def read(self, offset: int, games: int) -> None:
+        self.current = (offset, games)
+
+    # the game being read, number `game`, is sent to analysis
+    def start(self, game: int) -> None:
+        with self.lock:
+            self.pending[game] = self.current
+
+    def finish(self, game: int, puzzles: int) -> None:
+        with self.lock:
+            self.pending.pop(game, None)
+            self.progress.puzzles += puzzles
+
+    # whether it saved
+    def tick(self) -> bool:
+        if time.monotonic() > self.saved_at + self.interval:
+            self.save()
+            return True
+        return False
+
+    def save(self) -> None:
+        with self.lock:
+            self.progress.offset, self.progress.games = min(self.pending.values()) if self.pending else self.current
+            tmp = self.path + ".tmp"
+            with open(tmp, "w") as f:
+                json.dump(asdict(self.progress), f)
+            os.replace(tmp, self.path)
+            self.saved_at = time.monotonic()
+
+def load(path: str) -> Optional[Progress]:
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return Progress(**json.load(f))
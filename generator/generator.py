@@ -6,26 +6,52 @@ import requests
 import chess
 import chess.pgn
 import chess.engine
-import copy
+import chess.syzygy
 import sys
+import os
+import signal
 import util
-import bz2
+import numpy as np
+import dataclasses
+from multiprocessing import Pool, Value
+from multiprocessing.pool import ThreadPool
+from multiprocessing.util import Finalize
+from threading import BoundedSemaphore, local
+from functools import partial
 from model import Puzzle, EngineMove, NextMovePair
 from io import StringIO
 from chess import Move, Color, Board
 from chess.engine import SimpleEngine, Mate, Cp, Score, PovScore
 from chess.pgn import Game, GameNode
-from typing import List, Optional, Tuple, Literal, Union
-from util import EngineMove, get_next_move_pair, material_count, material_diff, is_up_in_material, win_chances
+from typing import List, Optional, Tuple, Literal, Union, Dict, Any, Set, cast
+from util import EngineMove, get_next_move_pair, get_mate_move_pair, material_count, material_diff, is_up_in_material, win_chances
 from server import Server
+import server as server_module
+from cache import AnalysisCache, CacheMiss, CacheOnlyEngine
+from cassette import RecordingEngine, ReplayEngine
+from spool import Spool
+from positions import PositionIndex, position_key
+from reader import open_file, is_game_start
+import index
+import metrics
+import checkpoint
+from checkpoint import Checkpoint, Progress
+from metrics import Exporter, Metrics, Stopwatch
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(format='%(asctime)s %(levelname)-4s %(message)s', datefmt='%m/%d %H:%M')
 
 version = 19
 get_move_limit = chess.engine.Limit(depth = 50, time = 30, nodes = 40_000_000)
+# defender plies only search the best reply, as long as is_valid_defense accepts any reply
+defense_limit = get_move_limit
 mate_soon = Mate(15)
 allow_one_mover = False
+# attack searches stop once is_valid_attack is settled from this depth on, see is_attack_decided
+early_stop_depth: Optional[int] = None
+early_stop_margin = 0.2
+# searches of a game don't reuse the hash entries of the games before, see --clear-hash
+clear_hash = False
 
 # is pair.best the only continuation?
 def is_valid_attack(pair: NextMovePair) -> bool:
@@ -42,8 +68,7 @@ def is_valid_attack(pair: NextMovePair) -> bool:
     # if best move is mate, and second move still good but doesn't win material,
     # then best move is valid attack
     if pair.best.score.is_mate() and pair.second.score < Cp(400):
-        next_node = pair.node.add_variation(pair.second.move)
-        return not "x" in next_node.san()
+        return not pair.board.is_capture(pair.second.move)
     return False
 
 def is_valid_defense(pair: NextMovePair) -> bool:
@@ -52,9 +77,29 @@ def is_valid_defense(pair: NextMovePair) -> bool:
         return True
     return win_chances(pair.second.score) > win_chances(pair.best.score) + 0.25
 
-def get_next_move(engine: SimpleEngine, node: GameNode, winner: Color) -> Optional[NextMovePair]:
-    board = node.board()
-    pair = get_next_move_pair(engine, node, winner, get_move_limit)
+# is the verdict of is_valid_attack clear enough not to search deeper?
+def is_attack_decided(depth: int, pair: NextMovePair) -> bool:
+    if early_stop_depth is None or depth < early_stop_depth or pair.second is None:
+        return False
+    # mate distances settle late, leave those to the full search
+    if pair.best.score.is_mate() or pair.second.score.is_mate():
+        return False
+    gap = win_chances(pair.best.score) - win_chances(pair.second.score)
+    return gap > 0.5 + early_stop_margin or gap < 0.5 - early_stop_margin
+
+# `mate`: the attacker is known to mate in that many moves, and the search may stop once it proves it.
+# Tablebases don't tell mate distances, so they only settle positions of advantage lines.
+def get_next_move(engine: SimpleEngine, board: Board, winner: Color, mate: Optional[int] = None) -> Optional[NextMovePair]:
+    tablebase = worker.tablebase if mate is None else None
+    if board.turn != winner:
+        pair = get_next_move_pair(engine, board, winner, defense_limit, worker.cache, multipv = 1, tablebase = tablebase)
+    elif mate is not None:
+        pair = get_mate_move_pair(engine, board, winner, dataclasses.replace(get_move_limit, mate = mate), worker.cache)
+    elif early_stop_depth is not None:
+        pair = get_next_move_pair(engine, board, winner, get_move_limit, worker.cache,
+                decided = is_attack_decided, tag = " early {} {}".format(early_stop_depth, early_stop_margin), tablebase = tablebase)
+    else:
+        pair = get_next_move_pair(engine, board, winner, get_move_limit, worker.cache, tablebase = tablebase)
     logger.debug("{} {} {}".format("attack" if board.turn == winner else "defense", pair.best, pair.second))
     if board.turn == winner and not is_valid_attack(pair):
         logger.debug("No valid attack {}".format(pair))
@@ -64,12 +109,14 @@ def get_next_move(engine: SimpleEngine, node: GameNode, winner: Color) -> Option
         return None
     return pair
 
-def cook_mate(engine: SimpleEngine, node: GameNode, winner: Color) -> Optional[List[Move]]:
+# the search line is played on copies of `board`, which keep its move stack for repetitions.
+# `mate` is the expected mate distance, which each search proves and shortens.
+def cook_mate(engine: SimpleEngine, board: Board, winner: Color, mate: Optional[int] = None) -> Optional[List[Move]]:
 
-    if node.board().is_game_over():
+    if board.is_game_over():
         return []
 
-    pair = get_next_move(engine, node, winner)
+    pair = get_next_move(engine, board, winner, mate)
 
     if not pair:
         return None
@@ -80,7 +127,8 @@ def cook_mate(engine: SimpleEngine, node: GameNode, winner: Color) -> Optional[L
         logger.info("Best move is not a mate, we're probably not searching deep enough")
         return None
 
-    follow_up = cook_mate(engine, node.add_main_variation(next.move), winner)
+    # after a defender move, its score is the distance of the mate the attacker searches next
+    follow_up = cook_mate(engine, util.pushed(board, next.move), winner, next.score.mate())
 
     if follow_up is None:
         return None
@@ -88,20 +136,19 @@ def cook_mate(engine: SimpleEngine, node: GameNode, winner: Color) -> Optional[L
     return [next.move] + follow_up
 
 
-def cook_advantage(engine: SimpleEngine, node: GameNode, winner: Color) -> Optional[List[NextMovePair]]:
+def cook_advantage(engine: SimpleEngine, board: Board, winner: Color) -> Optional[List[NextMovePair]]:
 
-    is_capture = "x" in node.san() # monkaS
-    up_in_material = is_up_in_material(node.board(), winner)
+    up_in_material = is_up_in_material(board, winner)
 
-    if node.board().is_repetition(2):
+    if board.is_repetition(2):
         logger.info("Found repetition, canceling")
         return None
 
-    # if not is_capture and up_in_material and len(node.board().checkers()) == 0:
+    # if not is_capture and up_in_material and len(board.checkers()) == 0:
     #     logger.info("Not a capture and we're up in material, end of the line")
     #     return []
 
-    next = get_next_move(engine, node, winner)
+    next = get_next_move(engine, board, winner)
 
     if not next:
         logger.debug("No next move")
@@ -111,7 +158,7 @@ def cook_advantage(engine: SimpleEngine, node: GameNode, winner: Color) -> Optio
         logger.info("Expected advantage, got mate?!")
         return None
 
-    follow_up = cook_advantage(engine, node.add_main_variation(next.best.move), winner)
+    follow_up = cook_advantage(engine, util.pushed(board, next.best.move), winner)
 
     if follow_up is None:
         return None
@@ -119,11 +166,50 @@ def cook_advantage(engine: SimpleEngine, node: GameNode, winner: Color) -> Optio
     return [next] + follow_up
 
 
+# the analyze_position rules that only depend on evals, for all plies of a game at once.
+# `scores` are evals from white's point of view, in the `util.mate_score` scale,
+# and `winner` is the side to move after the first ply.
+# Returns the plies analyze_position rejects as already winning, as mate in one, and as without swing.
+def prescreen_exits(scores: np.ndarray, winner: Color) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    pov = np.where(np.arange(len(scores)) % 2 == 0, 1, -1) * (1 if winner == chess.WHITE else -1)
+    score = scores * pov
+    prev_score = np.concatenate(([20], -score))[:-1]
+    already_winning = prev_score > 400
+    mate_in_one = ~already_winning & (score >= Mate(1).score(mate_score = util.mate_score)) & (not allow_one_mover)
+    mate = score > mate_soon.score(mate_score = util.mate_score)
+    advantage = (score >= 0) & (util.win_chances_array(score) > util.win_chances_array(prev_score) + 0.5)
+    no_swing = ~already_winning & ~mate_in_one & ~(mate | advantage)
+    return already_winning, mate_in_one, no_swing
+
+def candidate_plies(scores: np.ndarray, winner: Color) -> np.ndarray:
+    already_winning, mate_in_one, no_swing = prescreen_exits(scores, winner)
+    return np.flatnonzero(~(already_winning | mate_in_one | no_swing))
+
+# scans the raw movetext of a game, so that games which can't produce a puzzle
+# are rejected before going through chess.pgn
+def prescreen(movetext: str) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    return prescreen_exits(util.read_evals(movetext), chess.BLACK)
+
+def has_candidate(movetext: str) -> bool:
+    return is_candidate(prescreen(movetext))
+
+def is_candidate(exits: Tuple[np.ndarray, np.ndarray, np.ndarray]) -> bool:
+    return not (exits[0] | exits[1] | exits[2]).all()
+
+# plies rejected by the prescreen are counted like the exits of analyze_position, without engine time.
+# Only for games rejected there or analyzed, so that games already seen don't count.
+def count_prescreen_exits(exits: Tuple[np.ndarray, np.ndarray, np.ndarray]) -> None:
+    for reason, plies in zip(["already_winning", "mate_in_one", "no_swing"], exits):
+        metrics.count("exit_" + reason, int(plies.sum()))
+        metrics.count("exit_{}_engine_seconds".format(reason), 0)
+
+
 def analyze_game(server: Server, engine: SimpleEngine, game: Game) -> Optional[Puzzle]:
 
     logger.debug("Analyzing game {}...".format(game.headers.get("Site")))
 
-    prev_score: Score = Cp(20)
+    nodes: List[GameNode] = []
+    evals: List[PovScore] = []
 
     for node in game.mainline():
 
@@ -131,28 +217,54 @@ def analyze_game(server: Server, engine: SimpleEngine, game: Game) -> Optional[P
 
         if not current_eval:
             logger.debug("Skipping game without eval on ply {}".format(node.ply()))
-            return None
+            break
+
+        nodes.append(node)
+        evals.append(current_eval)
+
+    if not nodes:
+        return None
 
-        result = analyze_position(server, engine, node, prev_score, current_eval)
+    scores = np.array([e.white().score(mate_score = util.mate_score) for e in evals])
+    # one board pushed along the mainline, rather than node.board() replaying the game each time
+    board = game.board()
+    pushed = 0
+
+    for i in candidate_plies(scores, nodes[0].turn()):
+
+        for node in nodes[pushed:i + 1]:
+            board.push(node.move)
+        pushed = i + 1
+
+        node = nodes[i]
+        prev_score = evals[i - 1].pov(node.turn()) if i > 0 else Cp(20)
+
+        result = analyze_position(server, engine, node, prev_score, evals[i], board)
 
         if isinstance(result, Puzzle):
             return result
 
-        prev_score = -result
-
     logger.debug("Found nothing from {}".format(game.headers.get("Site")))
 
     return None
 
 
-def analyze_position(server: Server, engine: SimpleEngine, node: GameNode, prev_score: Score, current_eval: PovScore) -> Union[Puzzle, Score]:
+# `board` is the position after node, if the caller already has it. It is left unchanged.
+def analyze_position(server: Server, engine: SimpleEngine, node: GameNode, prev_score: Score, current_eval: PovScore, board: Optional[Board] = None) -> Union[Puzzle, Score]:
 
-    board = node.board()
+    board = node.board() if board is None else board
     winner = board.turn
     score = current_eval.pov(winner)
+    engine_start = metrics.elapsed("engine")
+
+    # every exit is counted by reason, with the engine time spent on the position
+    def verdict(reason: str, result: Union[Puzzle, Score]) -> Union[Puzzle, Score]:
+        metrics.count("exit_" + reason)
+        metrics.count("exit_{}_engine_seconds".format(reason), metrics.elapsed("engine") - engine_start)
+        return result
 
     if board.legal_moves.count() < 2:
-        return score
+        return verdict("forced_move", score)
 
     game_url = node.game().headers.get("Site")
 
@@ -160,98 +272,344 @@ def analyze_position(server: Server, engine: SimpleEngine, node: GameNode, prev_
 
     if prev_score > Cp(400):
         logger.debug("{} Too much of a winning position to start with {} -> {}".format(node.ply(), prev_score, score))
-        return score
+        return verdict("already_winning", score)
     if is_up_in_material(board, winner):
         logger.debug("{} already up in material {} {} {}".format(node.ply(), winner, material_count(board, winner), material_count(board, not winner)))
-        return score
+        return verdict("up_in_material", score)
     elif score >= Mate(1) and not allow_one_mover:
         logger.debug("{} mate in one".format(node.ply()))
-        return score
+        return verdict("mate_in_one", score)
     elif score > mate_soon:
         logger.info("Mate {}#{} Probing...".format(game_url, node.ply()))
-        if server.is_seen_pos(node):
+        if server.is_seen_pos(node, board):
             logger.info("Skip duplicate position")
-            return score
-        mate_solution = cook_mate(engine, copy.deepcopy(node), winner)
+            return verdict("duplicate_position", score)
+        mate_solution = cook_mate(engine, board, winner, score.mate())
         server.set_seen(node.game())
-        return Puzzle(node, mate_solution) if mate_solution is not None else score
+        if mate_solution is None:
+            return verdict("mate_not_found", score)
+        return verdict("mate_puzzle", Puzzle(node, mate_solution))
     elif score >= Cp(0) and win_chances(score) > win_chances(prev_score) + 0.5:
         if score < Cp(400) and material_diff(board, winner) > -1:
             logger.info("Not clearly winning and not from being down in material, aborting")
-            return score
+            return verdict("not_clearly_winning", score)
         logger.info("Advantage {}#{} {} -> {}. Probing...".format(game_url, node.ply(), prev_score, score))
-        if server.is_seen_pos(node):
+        if server.is_seen_pos(node, board):
             logger.info("Skip duplicate position")
-            return score
-        puzzle_node = copy.deepcopy(node)
-        solution : Optional[List[NextMovePair]] = cook_advantage(engine, puzzle_node, winner)
+            return verdict("duplicate_position", score)
+        line : Optional[List[NextMovePair]] = cook_advantage(engine, board, winner)
         server.set_seen(node.game())
-        if not solution:
-            return score
+        if not line:
+            return verdict("no_advantage_line", score)
+        solution = line
         while len(solution) % 2 == 0 or not solution[-1].second:
             if not solution[-1].second:
                 logger.info("Remove final only-move")
             solution = solution[:-1]
         if not solution or (len(solution) == 1 and not allow_one_mover):
             logger.info("Discard one-mover")
-            return score
-        last = list(puzzle_node.mainline())[len(solution)]
-        gain = material_diff(last.board(), winner) - material_diff(board, winner)
+            return verdict("one_mover", score)
+        # material after the reply to the last solution move
+        last = board.copy(stack = False)
+        for pair in line[:len(solution) + 1]:
+            last.push(pair.best.move)
+        gain = material_diff(last, winner) - material_diff(board, winner)
         if gain > 1 or (
             len(solution) == 1 and 
             win_chances(solution[0].best.score) > win_chances(solution[0].second.score) + 0.5):
-            return Puzzle(node, [p.best.move for p in solution])
-        return score
+            return verdict("advantage_puzzle", Puzzle(node, [p.best.move for p in solution]))
+        return verdict("insufficient_gain", score)
     else:
-        return score
-
-
-def parse_args() -> argparse.Namespace:
+        return verdict("no_swing", score)
+
+
+# how many positions left analyze_position by each exit, and the engine time they took
+def log_funnel(totals: Metrics) -> None:
+    with totals.lock:
+        counters = dict(totals.counters)
+    reasons = sorted((name[5:] for name in counters if name.startswith("exit_") and not name.endswith("_engine_seconds")),
+            key = lambda reason: -counters["exit_{}_engine_seconds".format(reason)])
+    if counters.get("cache_miss_games"):
+        print("{:.0f} games skipped for searches missing from the cache".format(counters["cache_miss_games"]))
+    if not reasons:
+        return
+    engine = sum(counters["exit_{}_engine_seconds".format(reason)] for reason in reasons)
+    print("Positions by exit, with their share of {:.0f} engine seconds:".format(engine))
+    for reason in reasons:
+        seconds = counters["exit_{}_engine_seconds".format(reason)]
+        print("{:>20} {:>10.0f} {:>10.0f}s {:>5.1f}%".format(reason, counters["exit_" + reason], seconds, 100 * seconds / engine if engine else 0))
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
     parser = argparse.ArgumentParser(
         prog='generator.py',
         description='takes a pgn file and produces chess puzzles')
+    parser.add_argument("--config", help="JSON object of defaults for the other options, by their long name with underscores", metavar="FILE.json")
     parser.add_argument("--file", "-f", help="input PGN file", required=True, metavar="FILE.pgn")
     parser.add_argument("--engine", "-e", help="analysis engine", default="stockfish")
-    parser.add_argument("--threads", "-t", help="count of cpu threads for engine searches", default="4")
+    parser.add_argument("--threads", "-t", help="count of cpu threads for engine searches", type=int, default=4)
+    parser.add_argument("--hash", help="engine hash size", type=int, metavar="MB")
+    parser.add_argument("--affinity", help="cpus of each engine process, e.g. 0-7:8-15 for two engines. Sets are reused when there are more engines", metavar="CPUS:CPUS...")
+    parser.add_argument("--clear-hash", help="clear the engine hash between games", action="store_true")
     parser.add_argument("--url", "-u", help="URL where to post puzzles", default="http://localhost:8000")
     parser.add_argument("--token", help="Server secret token", default="changeme")
+    parser.add_argument("--spill", help="file where puzzles wait while the server can't take them", default="puzzles.spill.ndjson", metavar="FILE.ndjson")
+    parser.add_argument("--out", "-o", help="write puzzles to numbered NDJSON files instead of the server, see upload.py", metavar="FILE.ndjson[.zst]")
+    parser.add_argument("--out-rotate", help="count of puzzles in each --out file", type=int, default=100_000)
     parser.add_argument("--skip", help="How many games to skip from the source", default="0")
+    parser.add_argument("--shard", help="only process the Ith of N equal parts of the input", metavar="I/N")
+    parser.add_argument("--checkpoint", help="file where progress is saved, defaults to FILE.checkpoint in the working directory")
+    parser.add_argument("--resume", help="resume from the last checkpoint", action="store_true")
+    parser.add_argument("--cache", help="sqlite file where engine results are kept across runs", metavar="FILE.sqlite")
+    parser.add_argument("--positions", help="index of the positions of existing puzzles, checked instead of the server, see positions.py", metavar="FILE.npy")
+    parser.add_argument("--cache-only", help="never search, and skip the games which need a search --cache doesn't have", action="store_true")
+    parser.add_argument("--syzygy", help="directory of Syzygy tablebases, which answer endgame positions instead of the engine", metavar="PATH")
+    parser.add_argument("--nodes", help="search every position to this count of nodes only, which with one thread and --clear-hash gives the same results on every run", type=int)
+    parser.add_argument("--early-stop", help="stop attack searches from this depth on, once their verdict is clear", type=int, metavar="DEPTH")
+    parser.add_argument("--metrics", help="file rewritten every 15 seconds with counters and timings of each stage, in Prometheus text format if it ends with .prom", metavar="FILE.json|FILE.prom")
+    parser.add_argument("--record", help="write the engine searches to a cassette, which --replay serves without an engine", metavar="FILE.json")
+    parser.add_argument("--replay", help="answer engine searches from a cassette written by --record", metavar="FILE.json")
+    parser.add_argument("--workers", "-w", help="count of workers, each running its own engine", type=int, default=1)
+    parser.add_argument("--pool", help="run workers as processes, or as threads of this process sharing its memory and its GIL", choices=["process", "thread"], default="process")
     parser.add_argument("--verbose", "-v", help="increase verbosity", action="count")
 
-    return parser.parse_args()
-
-
-def make_engine(executable: str, threads: int) -> SimpleEngine:
+    config, _ = parser.parse_known_args(argv)
+    if config.config:
+        with open(config.config) as f:
+            parser.set_defaults(**json.load(f))
+    return parser.parse_args(argv)
+
+# "0-3,8:4-7" -> [{0, 1, 2, 3, 8}, {4, 5, 6, 7}]
+def parse_affinity(spec: str) -> List[Set[int]]:
+    sets = []
+    for cpus in spec.split(":"):
+        cpu_set: Set[int] = set()
+        for part in cpus.split(","):
+            first, _, last = part.partition("-")
+            cpu_set.update(range(int(first), int(last or first) + 1))
+        sets.append(cpu_set)
+    return sets
+
+
+def make_engine(executable: str, threads: int, hash: Optional[int] = None, cpus: Optional[Set[int]] = None) -> SimpleEngine:
     engine = SimpleEngine.popen_uci(executable)
+    # before configuring Threads, so that search threads are started on these cpus
+    if cpus:
+        os.sched_setaffinity(engine.transport.get_pid(), cpus)
     engine.configure({'Threads': threads})
+    if hash is not None:
+        engine.configure({'Hash': hash})
     return engine
 
 
-def open_file(file: str):
-    if file.endswith(".bz2"):
-        return bz2.open(file, "rt")
-    return open(file)
-
-def main() -> None:
-    sys.setrecursionlimit(10000) # else node.deepcopy() sometimes fails?
-    args = parse_args()
+# engine and server owned by the current worker, process or thread, see init_worker
+class Worker(local):
+    engine: Optional[SimpleEngine] = None
+    server: Optional[Server] = None
+    cache: Optional[AnalysisCache] = None
+    tablebase: Optional[chess.syzygy.Tablebase] = None
+
+worker = Worker()
+# every engine started by this process. Their event loops run on non-daemon threads,
+# which keep the process alive until the engines are closed.
+worker_engines: List[SimpleEngine] = []
+
+# runs once in each worker, pool process or thread, or in this process without --workers.
+# Each worker starts its own engine and Server, so that engine calls never cross a process boundary.
+# `engines` counts the engines started by all workers, to give each its own cpus
+def init_worker(args: argparse.Namespace, engines: Any) -> None:
+    global early_stop_depth, clear_hash, get_move_limit, defense_limit
+    early_stop_depth = args.early_stop
+    clear_hash = args.clear_hash
+    if args.nodes:
+        get_move_limit = defense_limit = chess.engine.Limit(nodes = args.nodes)
+    cpus = None
+    if args.affinity:
+        with engines.get_lock():
+            number = engines.value
+            engines.value += 1
+        sets = parse_affinity(args.affinity)
+        cpus = sets[number % len(sets)]
+    # cassettes stand for the few SimpleEngine methods the generator uses
+    if args.replay:
+        worker.engine = cast(SimpleEngine, ReplayEngine(args.replay))
+    elif args.cache_only:
+        worker.engine = cast(SimpleEngine, CacheOnlyEngine(cache_engine(args.cache)))
+    else:
+        worker.engine = make_engine(args.engine, args.threads, args.hash, cpus)
+    if args.record:
+        worker.engine = cast(SimpleEngine, RecordingEngine(worker.engine, args.record))
+    worker.server = Server(logger, args.url, args.token, version)
+    worker_engines.append(worker.engine)
+    Finalize(worker.server, worker.server.close, exitpriority=10)
+    if args.positions:
+        worker.server.positions = PositionIndex(args.positions)
+    # pool workers exit without running atexit hooks, but they do run finalizers
+    Finalize(worker.engine, worker.engine.close, exitpriority=10)
+    if args.cache:
+        worker.cache = AnalysisCache(args.cache, worker.engine.id.get("name", "?"))
+        Finalize(worker.cache, worker.cache.close, exitpriority=10)
+    if args.syzygy:
+        worker.tablebase = chess.syzygy.open_tablebase(args.syzygy)
+        Finalize(worker.tablebase, worker.tablebase.close, exitpriority=10)
+
+# the engine which filled the cache, which --cache-only stands for
+def cache_engine(path: str) -> str:
+    cache = AnalysisCache(path, "")
+    names = cache.engines()
+    cache.close()
+    if len(names) != 1:
+        raise ValueError("--cache-only needs a cache of one engine, {} has {}".format(path, names))
+    return names[0]
+
+def close_engines() -> None:
+    for engine in worker_engines:
+        engine.close()
+
+# the puzzle, and the metrics recorded by this worker since its last game
+def work(game_id: str, pgn: str) -> Tuple[Optional[Dict[str, Any]], metrics.Snapshot]:
+    engine, server = worker.engine, worker.server
+    assert engine is not None and server is not None, "init_worker wasn't called"
+    with metrics.timer("parse"):
+        game = chess.pgn.read_game(StringIO(pgn))
+    try:
+        if clear_hash:
+            engine.configure({"Clear Hash": None})
+        with metrics.timer("analysis"):
+            puzzle = analyze_game(server, engine, game)
+        return (server.puzzle_json(game_id, puzzle) if puzzle is not None else None), metrics.drain()
+    except CacheMiss as e:
+        logger.debug("Not in the cache, skipping {}: {}".format(game_id, e))
+        metrics.count("cache_miss_games")
+        return None, metrics.drain()
+    except Exception as e:
+        logger.error("Exception on {}: {}".format(game_id, e))
+        return None, metrics.drain()
+
+# `argv` defaults to the command line
+def main(argv: Optional[List[str]] = None) -> None:
+    args = parse_args(argv)
     if args.verbose == 2:
         logger.setLevel(logging.DEBUG)
     elif args.verbose == 1:
         logger.setLevel(logging.INFO)
-    engine = make_engine(args.engine, args.threads)
-    server = Server(logger, args.url, args.token, version)
+    if args.out:
+        # keep the server out of the way entirely, it will dedupe puzzles on upload
+        args.url = ""
+    spool = Spool(args.out, args.out_rotate) if args.out else None
+    server = Server(logger, args.url, args.token, version, args.spill)
+    # games read ahead of the workers, so that a free worker never waits on the PGN stream
+    slots = BoundedSemaphore(args.workers * 2)
     games = 0
     skip = int(args.skip)
+    start, end = 0, None
+    shard = tuple(map(int, args.shard.split("/"))) if args.shard else None
+    if args.cache_only and not args.cache:
+        logger.error("--cache-only needs --cache")
+        sys.exit(1)
+    if args.record and args.workers > 1:
+        logger.error("--record needs a single worker")
+        sys.exit(1)
+    if shard:
+        if skip:
+            logger.error("--skip can't be combined with --shard")
+            sys.exit(1)
+        try:
+            start, end = index.shard_range(args.file, *shard)
+        except ValueError as e:
+            logger.error(e)
+            sys.exit(1)
+        logger.info("Shard {}/{}: offsets {} to {}".format(*shard, start, end))
+    if args.affinity:
+        try:
+            cpus = set().union(*parse_affinity(args.affinity))
+        except ValueError:
+            logger.error("Invalid --affinity {}".format(args.affinity))
+            sys.exit(1)
+        if not cpus <= os.sched_getaffinity(0):
+            logger.error("--affinity has cpus outside of {}".format(sorted(os.sched_getaffinity(0))))
+            sys.exit(1)
+    checkpoint_path = args.checkpoint or "{}{}.checkpoint".format(os.path.basename(args.file), ".{}-{}".format(*shard) if shard else "")
+    resumed = checkpoint.load(checkpoint_path) if args.resume else None
+    if resumed:
+        if resumed.file != os.path.abspath(args.file):
+            logger.error("Checkpoint {} is for another file: {}".format(checkpoint_path, resumed.file))
+            sys.exit(1)
+        skip = 0
+        games, start = resumed.games, resumed.offset
+        logger.info("Resuming from game {} at offset {}".format(games, start))
+    elif args.resume:
+        logger.warning("No checkpoint in {}, starting over".format(checkpoint_path))
     logger.info("Skipping first {} games".format(skip))
+    game_index = index.load(args.file) if skip else None
+    if game_index:
+        games, start = game_index.seek(skip)
+        logger.info("Seeking to game {} at offset {}".format(games, start))
+    progress = Checkpoint(checkpoint_path, resumed or Progress(os.path.abspath(args.file), start, games, 0))
+    # totals of the metrics of all workers, also written to a file with --metrics
+    exporter = Exporter(args.metrics)
+    server.load_seen()
+    # forked workers would otherwise inherit the keep-alive connection of the download,
+    # and interleave their requests on it. Requests open new connections after this.
+    server_module.http.close()
+    # forked workers would also inherit what this process recorded so far, and report it again
+    exporter.add(metrics.drain())
+    engines = Value("i", 0)
+    # with threads, the engines search in their own processes while the GIL is released,
+    # and the pool shares this process' memory, parsed input and HTTP connections
+    pool = (ThreadPool if args.pool == "thread" else Pool)(args.workers, init_worker, (args, engines)) if args.workers > 1 else None
+    if pool is None:
+        init_worker(args, engines)
+    # stop like on Ctrl-C when the machine goes away, after the workers are forked
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+    # positions of the puzzles of this run. Workers can't see those of the others,
+    # and neither the --positions index nor a spool knows about them.
+    found: Set[int] = set()
+
+    # called on a single thread, whether results come from the pool or from this process
+    def done(games: int, result: Tuple[Optional[Dict[str, Any]], metrics.Snapshot]) -> None:
+        slots.release()
+        puzzle, snapshot = result
+        exporter.add(snapshot)
+        if puzzle is not None:
+            key = position_key(Board(puzzle["fen"]), Move.from_uci(puzzle["moves"][0]))
+            if key in found:
+                logger.info("Skip duplicate position of game {}".format(games))
+                metrics.count("duplicate_puzzles")
+                puzzle = None
+            found.add(key)
+        if puzzle is not None:
+            metrics.count("puzzles")
+            print("Game {}".format(games))
+            if spool is not None:
+                spool.write(puzzle)
+            else:
+                server.post_json(puzzle)
+        progress.finish(games, 0 if puzzle is None else 1)
+
+    def failed(games: int, e: BaseException) -> None:
+        slots.release()
+        logger.error("Worker failure on game {}: {}".format(games, e))
+        progress.finish(games, 0)
 
     try:
-        with open_file(args.file) as pgn:
+        # a shard starts anywhere in the input, but resumes and index seeks start on a game
+        with open_file(args.file, start, end, align = shard is not None and not resumed) as pgn:
             skip_next = False
+            # wall time of this loop, by stage
+            watch = Stopwatch("scan")
             for line in pgn:
-                if line.startswith("[Site "):
+                if is_game_start(line):
+                    progress.read(pgn.offset, games)
+                    if progress.tick():
+                        exporter.save()
+                        log_funnel(exporter.totals)
+                    exporter.tick()
+                elif line.startswith("[Site "):
                     site = line
                     games = games + 1
+                    metrics.count("games")
                 elif games < skip:
                     continue
                 elif util.exclude_time_control(line) or util.exclude_rating(line):
@@ -260,24 +618,58 @@ def main() -> None:
                     logger.debug("Skip {}".format(site))
                     skip_next = False
                 elif "%eval" in line:
-                    game = chess.pgn.read_game(StringIO("{}\n{}".format(site, line)))
-                    game_id = game.headers.get("Site", "?")[20:]
+                    game_id = site.split('"')[1][20:]
+                    metrics.count("prescreened_games")
+                    watch.switch("prescreen")
+                    exits = prescreen(line)
+                    if not is_candidate(exits):
+                        count_prescreen_exits(exits)
+                        watch.switch("scan")
+                        logger.debug("No candidate in {}".format(game_id))
+                        continue
+                    metrics.count("candidate_games")
+                    watch.switch("seen")
                     if server.is_seen(game_id):
+                        watch.switch("scan")
                         logger.info("Game was already seen before")
                         continue
-
-                    try:
-                        puzzle = analyze_game(server, engine, game)
-                        if puzzle is not None:
-                            print("Game {}".format(games))
-                            server.post(game_id, puzzle)
-                    except Exception as e:
-                        logger.error("Exception on {}: {}".format(game_id, e))
+                    count_prescreen_exits(exits)
+                    metrics.count("analyzed_games")
+                    # waiting for a free worker, or analyzing without a pool
+                    watch.switch("dispatch")
+                    slots.acquire()
+                    progress.start(games)
+                    # the worker parses the game again from its Site line and movetext, which pickle cheaply
+                    pgn_text = "{}\n{}".format(site, line)
+                    if pool is None:
+                        done(games, work(game_id, pgn_text))
+                    else:
+                        pool.apply_async(work, (game_id, pgn_text), callback = partial(done, games), error_callback = partial(failed, games))
+                    watch.switch("scan")
+            progress.read(pgn.offset, games)
     except KeyboardInterrupt:
         print("\nLast game: {}".format(games))
+        if pool is not None:
+            pool.terminate()
+        close_engines()
+        server.close()
+        if spool is not None:
+            spool.close()
+        progress.save()
+        exporter.save()
+        log_funnel(exporter.totals)
         sys.exit(1) 
 
-    engine.close()
+    if pool is not None:
+        pool.close()
+        pool.join()
+    close_engines()
+    server.close()
+    if spool is not None:
+        spool.close()
+    progress.save()
+    exporter.save()
+    log_funnel(exporter.totals)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,78 @@
+import argparse
+import json
+import os
+import logging
+from dataclasses import dataclass, asdict
+from typing import List, Optional, Tuple
+from reader import open_file, is_game_start
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(format='%(asctime)s %(levelname)-4s %(message)s', datefmt='%m/%d %H:%M')
+logger.setLevel(logging.INFO)
+
+# Sidecar index of a PGN file: the offset in the decompressed stream of every `stride`th game.
+# Compressed files can't be entered mid-stream, so seeking into them still decompresses
+# up to the offset, but skips splitting and scanning lines.
+@dataclass
+class GameIndex:
+    file_size: int
+    stride: int
+    games: int
+    size: int
+    offsets: List[int]
+
+    # game number and offset of the closest indexed game at or before `game`
+    def seek(self, game: int) -> Tuple[int, int]:
+        i = min(game // self.stride, len(self.offsets) - 1)
+        return i * self.stride, self.offsets[i]
+
+def index_path(file: str) -> str:
+    return file + ".idx"
+
+def build(file: str, stride: int = 1000) -> GameIndex:
+    offsets: List[int] = []
+    games = 0
+    with open_file(file) as pgn:
+        for line in pgn:
+            if is_game_start(line):
+                if games % stride == 0:
+                    offsets.append(pgn.offset)
+                games = games + 1
+        size = pgn.offset
+    index = GameIndex(os.path.getsize(file), stride, games, size, offsets)
+    with open(index_path(file), "w") as f:
+        json.dump(asdict(index), f)
+    return index
+
+def load(file: str) -> Optional[GameIndex]:
+    path = index_path(file)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        index = GameIndex(**json.load(f))
+    if index.file_size != os.path.getsize(file) or not index.offsets:
+        logger.warning("Ignoring outdated index {}".format(path))
+        return None
+    return index
+
+def is_compressed(file: str) -> bool:
+    return file.endswith(".bz2") or file.endswith(".zst")
+
+# decompressed byte range of shard i out of n, numbered from 1
+def shard_range(file: str, i: int, n: int) -> Tuple[int, int]:
+    if is_compressed(file):
+        index = load(file)
+        if index is None:
+            raise ValueError("Sharding a compressed file needs its size, run index.py -f {} first".format(file))
+        size = index.size
+    else:
+        size = os.path.getsize(file)
+    return size * (i - 1) // n, size * i // n
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='index.py', description='indexes game offsets of a PGN file, for generator.py --skip')
+    parser.add_argument("--file", "-f", help="input PGN file", required=True, metavar="FILE.pgn")
+    parser.add_argument("--stride", help="index every Nth game", type=int, default=1000)
+    args = parser.parse_args()
+    index = build(args.file, args.stride)
+    logger.info("Indexed {} games into {}".format(index.games, index_path(args.file)))
@@ -0,0 +1,159 @@
+import json
+import os
+import time
+from contextlib import contextmanager
+from threading import Lock, local
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+# upper bounds of the timing buckets, in seconds
+buckets = [0.001, 0.01, 0.1, 1, 10, 60, 300]
+
+# counters, and timings as counts per bucket then beyond the last one, then their sum
+Snapshot = Tuple[Dict[str, float], Dict[str, List[float]]]
+
+class Metrics:
+    """
+    Counters and timing histograms by stage. Every process records into its own `recorder`,
+    and worker processes send what they recorded along with each game result, see drain.
+    """
+
+    def __init__(self) -> None:
+        self.lock = Lock()
+        self.counters: Dict[str, float] = {}
+        self.timings: Dict[str, List[float]] = {}
+
+    def count(self, name: str, value: float = 1) -> None:
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name: str, seconds: float) -> None:
+        i = next((i for i, bound in enumerate(buckets) if seconds <= bound), len(buckets))
+        with self.lock:
+            timing = self.timings.setdefault(name, [0.0] * (len(buckets) + 2))
+            timing[i] += 1
+            timing[-1] += seconds
+
+    # what was recorded since the last drain
+    def drain(self) -> Snapshot:
+        with self.lock:
+            snapshot = (self.counters, self.timings)
+            self.counters, self.timings = {}, {}
+        return snapshot
+
+    def merge(self, snapshot: Snapshot) -> None:
+        counters, timings = snapshot
+        with self.lock:
+            for name, value in counters.items():
+                self.counters[name] = self.counters.get(name, 0) + value
+            for name, timing in timings.items():
+                total = self.timings.setdefault(name, [0.0] * (len(buckets) + 2))
+                for i, value in enumerate(timing):
+                    total[i] += value
+
+recorder = Metrics()
+# seconds observed by the current thread, by name
+elapsed_by_thread = local()
+
+def count(name: str, value: float = 1) -> None:
+    recorder.count(name, value)
+
+def observe(name: str, seconds: float) -> None:
+    recorder.observe(name, seconds)
+    totals = elapsed_by_thread.__dict__
+    totals[name] = totals.get(name, 0) + seconds
+
+# total time of the current thread in `name`, to tell how much of it went into a task
+def elapsed(name: str) -> float:
+    return elapsed_by_thread.__dict__.get(name, 0)
+
+@contextmanager
+def timer(name: str) -> Iterator[None]:
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start)
+
+def drain() -> Snapshot:
+    return recorder.drain()
+
+class Stopwatch:
+    """
+    Splits the wall time of a loop between the stages it goes through,
+    as `<stage>_seconds` counters, without a histogram entry for each switch.
+    """
+
+    def __init__(self, stage: str) -> None:
+        self.stage = stage
+        self.at = time.perf_counter()
+
+    def switch(self, stage: str) -> None:
+        now = time.perf_counter()
+        recorder.count(self.stage + "_seconds", now - self.at)
+        self.stage, self.at = stage, now
+
+class Exporter:
+    """
+    Totals of all workers, rewritten to `path` every `interval` seconds,
+    as a Prometheus textfile if it ends with .prom, as JSON otherwise.
+    Without `path`, they are only kept in `totals`.
+    """
+
+    def __init__(self, path: Optional[str], interval: float = 15) -> None:
+        self.path = path
+        self.interval = interval
+        self.started_at = time.monotonic()
+        self.saved_at = self.started_at
+        self.totals = Metrics()
+
+    def add(self, snapshot: Snapshot) -> None:
+        self.totals.merge(snapshot)
+
+    def tick(self) -> None:
+        if time.monotonic() > self.saved_at + self.interval:
+            self.save()
+
+    def save(self) -> None:
+        self.totals.merge(drain())
+        self.saved_at = time.monotonic()
+        if self.path is None:
+            return
+        with self.totals.lock:
+            counters = dict(self.totals.counters)
+            timings = {name: list(timing) for name, timing in self.totals.timings.items()}
+        uptime = time.monotonic() - self.started_at
+        engine_hours = timings["engine"][-1] / 3600 if "engine" in timings else 0
+        rates = {
+            "uptime_seconds": uptime,
+            "games_per_second": counters.get("games", 0) / uptime if uptime else 0,
+            "puzzles_per_engine_hour": counters.get("puzzles", 0) / engine_hours if engine_hours else 0,
+        }
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            if self.path.endswith(".prom"):
+                f.write(prometheus(counters, timings, rates))
+            else:
+                json.dump({"rates": rates, "counters": counters, "timings": {
+                    name: histogram(timing) for name, timing in timings.items()
+                }}, f, indent = 2)
+        os.replace(tmp, self.path)
+
+def histogram(timing: List[float]) -> Dict[str, Any]:
+    cumulative, total = {}, 0.0
+    for bound, value in zip(buckets + ["+Inf"], timing):
+        total += value
+        cumulative[str(bound)] = total
+    return {"count": total, "sum": timing[-1], "buckets": cumulative}
+
+def prometheus(counters: Dict[str, float], timings: Dict[str, List[float]], rates: Dict[str, float]) -> str:
+    lines = []
+    for name, value in sorted(rates.items()):
+        lines += ["# TYPE generator_{} gauge".format(name), "generator_{} {}".format(name, value)]
+    for name, value in sorted(counters.items()):
+        lines += ["# TYPE generator_{}_total counter".format(name), "generator_{}_total {}".format(name, value)]
+    for name, timing in sorted(timings.items()):
+        h = histogram(timing)
+        lines.append("# TYPE generator_{}_seconds histogram".format(name))
+        lines += ['generator_{}_seconds_bucket{{le="{}"}} {}'.format(name, le, value) for le, value in h["buckets"].items()]
+        lines += ["generator_{}_seconds_sum {}".format(name, h["sum"]), "generator_{}_seconds_count {}".format(name, h["count"])]
+    return "\n".join(lines) + "\n"
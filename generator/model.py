@@ -1,5 +1,5 @@
 from chess.pgn import GameNode
-from chess import Move
+from chess import Move, Board
 from chess.engine import Score, Mate, Cp
 from dataclasses import dataclass
 from typing import List, Optional, Tuple, Literal, Union
@@ -16,6 +16,6 @@ class EngineMove:
 
 @dataclass
 class NextMovePair:
-    node: GameNode
+    board: Board
     best: EngineMove
     second: Optional[EngineMove]
@@ -0,0 +1,63 @@
+import argparse
+import logging
+import chess
+import chess.polyglot
+import numpy as np
+from chess import Board, Move
+from typing import Iterator, List, Tuple
+import spool
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(format='%(asctime)s %(levelname)-4s %(message)s', datefmt='%m/%d %H:%M')
+logger.setLevel(logging.INFO)
+
+mask = (1 << 64) - 1
+
+# a puzzle starts with `move` played from `board`. Unlike the FEN, the zobrist hash
+# ignores move counters, so the same position reached at another move is a duplicate too.
+def position_key(board: Board, move: Move) -> int:
+    code = move.from_square | move.to_square << 6 | (move.promotion or 0) << 12
+    return chess.polyglot.zobrist_hash(board) ^ (code * 0x9E3779B97F4A7C15 & mask)
+
+class PositionIndex:
+    """
+    Keys of the positions of existing puzzles, see position_key, in a sorted .npy file.
+    It is memory-mapped, so that workers share its pages, and searched by bisection.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.keys = np.load(path, mmap_mode = "r")
+
+    def __contains__(self, key: int) -> bool:
+        i = np.searchsorted(self.keys, np.uint64(key))
+        return bool(i < len(self.keys) and self.keys[i] == key)
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+def build(path: str, puzzles: Iterator[Tuple[str, str]]) -> int:
+    keys = np.fromiter((position_key(Board(fen), Move.from_uci(uci)) for fen, uci in puzzles), dtype = np.uint64)
+    keys = np.unique(keys)
+    np.save(path, keys)
+    return len(keys)
+
+def from_spool(files: List[str]) -> Iterator[Tuple[str, str]]:
+    for file in files:
+        for puzzle in spool.read(file):
+            yield puzzle["fen"], puzzle["moves"][0]
+
+def from_mongo(url: str, db: str) -> Iterator[Tuple[str, str]]:
+    import pymongo
+    coll = pymongo.MongoClient(url)[db]["puzzle2"]
+    for doc in coll.find({}, {"fen": True, "moves": {"$slice": 1}}):
+        yield doc["fen"], doc["moves"][0]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='positions.py', description='indexes the positions of existing puzzles, for generator.py --positions')
+    parser.add_argument("--out", "-o", help="index file", required=True, metavar="FILE.npy")
+    parser.add_argument("--mongo", help="read puzzles from the validator's mongodb", metavar="mongodb://HOST:PORT")
+    parser.add_argument("--db", help="mongodb database of the validator", default="puzzler")
+    parser.add_argument("files", help="read puzzles from spool files of generator.py --out", nargs="*", metavar="FILE.ndjson")
+    args = parser.parse_args()
+    puzzles = from_mongo(args.mongo, args.db) if args.mongo else from_spool(args.files)
+    logger.info("Indexed {} positions into {}".format(build(args.out, puzzles), args.out))
@@ -0,0 +1,106 @@
+import bz2
+import time
+import metrics
+from queue import Queue, Empty
+from threading import Thread, Event
+from typing import BinaryIO, Iterator, Optional, Union, cast
+
+
+class Reader:
+    """
+    Reads a possibly compressed file on a background thread, through a bounded queue of chunks,
+    so that decompression overlaps with analysis. Iterates over text lines like `open(file)`.
+    While a line is being processed, `offset` is its position in the decompressed stream.
+    With `align`, lines are only read from the first game starting at or after `start`,
+    and with `end`, until the first game starting at or after `end`.
+    """
+
+    def __init__(self, raw: BinaryIO, start: int = 0, end: Optional[int] = None, align: bool = False, chunk_size: int = 1 << 20, queue_size: int = 16) -> None:
+        self.raw = raw
+        self.align = align and start > 0
+        # the line before `start` is read to find out whether a line begins at `start`
+        self.offset = start - 1 if self.align else start
+        self.end = end
+        self.chunk_size = chunk_size
+        self.queue: Queue[Union[bytes, Exception]] = Queue(queue_size)
+        self.stopped = Event()
+        self.thread = Thread(target=self._read, daemon=True)
+        self.thread.start()
+
+    def _read(self) -> None:
+        try:
+            with self.raw:
+                if self.offset:
+                    # compressed streams emulate seeking by decompressing up to the offset
+                    self.raw.seek(self.offset)
+                while not self.stopped.is_set():
+                    start = time.perf_counter()
+                    chunk = self.raw.read(self.chunk_size)
+                    metrics.observe("decompress", time.perf_counter() - start)
+                    metrics.count("decompressed_bytes", len(chunk))
+                    self.queue.put(chunk)
+                    if not chunk:
+                        return
+        except Exception as e:
+            self.queue.put(e)
+
+    def __iter__(self) -> Iterator[str]:
+        lines = self._lines()
+        if self.align:
+            next(lines, None)
+        started = not self.align
+        for line in lines:
+            if is_game_start(line):
+                if self.end is not None and self.offset >= self.end:
+                    return
+                started = True
+            if started:
+                yield line
+
+    def _lines(self) -> Iterator[str]:
+        rest = b""
+        while True:
+            chunk = self.queue.get()
+            if isinstance(chunk, Exception):
+                raise chunk
+            if not chunk:
+                break
+            lines = (rest + chunk).split(b"\n")
+            rest = lines.pop()
+            for line in lines:
+                yield (line + b"\n").decode()
+                self.offset += len(line) + 1
+        if rest:
+            yield rest.decode()
+            self.offset += len(rest)
+
+    def close(self) -> None:
+        self.stopped.set()
+        # unblock the reader thread if it waits on a full queue
+        while self.thread.is_alive():
+            try:
+                self.queue.get(timeout = 0.1)
+            except Empty:
+                pass
+
+    def __enter__(self) -> "Reader":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+def open_file(file: str, start: int = 0, end: Optional[int] = None, align: bool = False) -> Reader:
+    raw: BinaryIO
+    if file.endswith(".zst"):
+        import zstandard
+        # lichess dumps may be compressed with long distance matching
+        raw = zstandard.ZstdDecompressor(max_window_size = 2 ** 31).stream_reader(open(file, "rb"))
+    elif file.endswith(".bz2"):
+        raw = cast(BinaryIO, bz2.open(file, "rb"))
+    else:
+        raw = open(file, "rb")
+    return Reader(raw, start, end, align)
+
+def is_game_start(line: str) -> bool:
+    return line.startswith("[Event ")
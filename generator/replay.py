@@ -0,0 +1,69 @@
+import argparse
+import json
+import os
+import sys
+import tempfile
+from typing import Any, Dict, Iterator, List, Tuple
+import generator
+import spool
+
+Puzzles = Dict[str, Dict[str, Any]]
+
+def load(paths: List[str]) -> Puzzles:
+    """
+    Puzzles of --out spools or upload.py files, by game, as the generator makes at most one per game.
+    A spool path also reads all its numbered parts.
+    """
+    puzzles: Puzzles = {}
+    for path in paths:
+        for part in (spool.parts(path) or [path]):
+            for puzzle in spool.read(part):
+                puzzles[puzzle["game_id"]] = puzzle
+    return puzzles
+
+def same(a: Dict[str, Any], b: Dict[str, Any]) -> bool:
+    return a["fen"] == b["fen"] and a["moves"] == b["moves"]
+
+def diff(before: Puzzles, after: Puzzles) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    """
+    ("gained", puzzle) and ("lost", puzzle) by game, and ("changed", puzzle after)
+    for games whose puzzle starts elsewhere or has another line
+    """
+    for game_id, puzzle in sorted(after.items()):
+        if game_id not in before:
+            yield "gained", puzzle
+        elif not same(before[game_id], puzzle):
+            yield "changed", dict(puzzle, before = before[game_id])
+    for game_id, puzzle in sorted(before.items()):
+        if game_id not in after:
+            yield "lost", puzzle
+
+def run(argv: List[str], out: str) -> Puzzles:
+    with tempfile.TemporaryDirectory() as tmp:
+        path = out or os.path.join(tmp, "puzzles.ndjson")
+        generator.main(argv + ["--out", path, "--checkpoint", os.path.join(tmp, "checkpoint")])
+        return load([path])
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='replay.py', description='runs generator.py again over games it already went through, answering its searches from --cache, and lists the puzzles gained and lost since the earlier run')
+    parser.add_argument("--before", help="puzzles of the earlier run, written with --out", nargs="+", required=True, metavar="FILE.ndjson")
+    parser.add_argument("--cache", help="sqlite file the earlier run kept its engine results in", required=True, metavar="FILE.sqlite")
+    parser.add_argument("--cache-only", help="never search, and skip the games the new rules need a search for that the cache doesn't have", action="store_true")
+    parser.add_argument("--out", help="also keep the puzzles of this run", metavar="FILE.ndjson")
+    parser.add_argument("--diff", help="write the gained, lost and changed puzzles there, as NDJSON with a `change` field", metavar="FILE.ndjson")
+    args, rest = parser.parse_known_args()
+    # the generator arguments of the earlier run, and its limits, so that its searches are found in the cache
+    argv = rest + ["--cache", args.cache] + (["--cache-only"] if args.cache_only else [])
+    before = load(args.before)
+    after = run(argv, args.out)
+    changes: Dict[str, int] = { "gained": 0, "lost": 0, "changed": 0 }
+    f = open(args.diff, "w") if args.diff else None
+    for change, puzzle in diff(before, after):
+        changes[change] += 1
+        if f:
+            f.write(json.dumps(dict(puzzle, change = change)) + "\n")
+    if f:
+        f.close()
+    unchanged = sum(1 for game_id in after if game_id in before and same(before[game_id], after[game_id]))
+    print("{} puzzles before, {} after: {} gained, {} lost, {} changed, {} unchanged".format(
+        len(before), len(after), changes["gained"], changes["lost"], changes["changed"], unchanged))
@@ -0,0 +1,57 @@
+import numpy as np
+from typing import Iterable, Iterator, List, Set, Tuple
+
+alphabet = b"0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ"
+# base 62 digit of each byte, 255 for bytes which are not digits
+digits = np.full(256, 255, dtype = np.uint8)
+digits[np.frombuffer(alphabet, dtype = np.uint8)] = np.arange(len(alphabet))
+powers = 62 ** np.arange(7, -1, -1, dtype = np.uint64)
+
+def pack(ids: List[bytes]) -> Tuple[np.ndarray, List[bytes]]:
+    """
+    lichess game ids are 8 base 62 digits, packed into 48 bits.
+    Returns the packed ids, and the ones of another shape which can't be packed.
+    """
+    others = [id for id in ids if len(id) != 8]
+    ids = [id for id in ids if len(id) == 8]
+    chars = digits[np.frombuffer(b"".join(ids), dtype = np.uint8)].reshape(-1, 8)
+    valid = (chars != 255).all(axis = 1)
+    others += np.array(ids, dtype = "S8")[~valid].tolist()
+    return (chars[valid].astype(np.uint64) * powers).sum(axis = 1, dtype = np.uint64), others
+
+class SeenGames:
+    """
+    Game ids known to the server, checked without a request for every game.
+    Packed ids take 8 bytes each, in a sorted array searched by bisection.
+    """
+
+    def __init__(self, lines: Iterable[bytes]) -> None:
+        packed = []
+        self.others: Set[bytes] = set()
+        for chunk in chunks(lines):
+            ids, others = pack(chunk)
+            packed.append(ids)
+            self.others.update(others)
+        self.ids = np.unique(np.concatenate(packed)) if packed else np.array([], dtype = np.uint64)
+
+    def __contains__(self, id: str) -> bool:
+        key = id.encode()
+        packed, _ = pack([key])
+        if len(packed) == 0:
+            return key in self.others
+        i = np.searchsorted(self.ids, packed[0])
+        return bool(i < len(self.ids) and self.ids[i] == packed[0])
+
+    def __len__(self) -> int:
+        return len(self.ids) + len(self.others)
+
+def chunks(lines: Iterable[bytes], size: int = 1 << 16) -> Iterator[List[bytes]]:
+    chunk = []
+    for line in lines:
+        if line:
+            chunk.append(line)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
@@ -0,0 +1,126 @@
+import json
+import logging
+import os
+import queue
+import requests
+import metrics
+from threading import Lock, Thread
+from typing import Any, List, Optional
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+# fewer retries than server.http: a batch which fails is spilled and sent again later
+retry_strategy = Retry(
+    total=3,
+    backoff_factor=1,
+    status_forcelist=[429, 500, 502, 503, 504],
+    method_whitelist=["POST"]
+)
+adapter = HTTPAdapter(max_retries=retry_strategy)
+http = requests.Session()
+http.mount("https://", adapter)
+http.mount("http://", adapter)
+
+class Sender:
+    """
+    Posts JSON items to `url` by batches, from a background thread, so that the analysis
+    never waits on the server. Items go through a bounded queue. When it is full, or when
+    a batch can't be posted, items are appended to the `spill` NDJSON file instead,
+    and sent again once the server accepts a batch, in this run or the next one.
+    Without a spill file, such items are dropped.
+    """
+
+    def __init__(self, logger: logging.Logger, url: str, spill: Optional[str] = None,
+            batch_size: int = 100, queue_size: int = 10_000, delay: float = 1) -> None:
+        self.logger = logger
+        self.url = url
+        self.spill = spill
+        self.batch_size = batch_size
+        # how long to wait for more items before posting a partial batch
+        self.delay = delay
+        self.queue: "queue.Queue[Any]" = queue.Queue(queue_size)
+        self.lock = Lock()
+        # started on the first item, so that no thread runs before the generator forks its workers
+        self.thread: Optional[Thread] = None
+
+    def put(self, item: Any) -> None:
+        with self.lock:
+            if self.thread is None:
+                self.thread = Thread(target = self._run, daemon = True)
+                self.thread.start()
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            self._spill([item])
+
+    # sends the queued items and stops the thread
+    def close(self) -> None:
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+    def _run(self) -> None:
+        self._resend_spill()
+        done = False
+        while not done:
+            batch: List[Any] = []
+            while len(batch) < self.batch_size:
+                try:
+                    item = self.queue.get(timeout = self.delay if batch else None)
+                except queue.Empty:
+                    break
+                if item is None:
+                    done = True
+                    break
+                batch.append(item)
+            if not batch:
+                continue
+            if self._post(batch):
+                self._resend_spill()
+            else:
+                self._spill(batch)
+
+    def _post(self, batch: List[Any]) -> bool:
+        try:
+            with metrics.timer("http"):
+                r = http.post(self.url, json = batch, timeout = 60)
+            if r.ok:
+                if r.text:
+                    self.logger.info(r.text)
+                return True
+            self.logger.error("FAILURE {}".format(r.text))
+        except Exception as e:
+            self.logger.error("Couldn't post {} items: {}".format(len(batch), e))
+        return False
+
+    def _spill(self, batch: List[Any]) -> None:
+        if self.spill is None:
+            self.logger.error("Dropped {} items for {}".format(len(batch), self.url.split("?")[0]))
+            return
+        with self.lock:
+            with open(self.spill, "a") as f:
+                for item in batch:
+                    f.write(json.dumps(item) + "\n")
+
+    # spilled items are moved aside while they are sent, and are sent again
+    # if the process stops before they all are
+    def _resend_spill(self) -> None:
+        if self.spill is None:
+            return
+        sending = self.spill + ".sending"
+        with self.lock:
+            if not os.path.exists(sending):
+                if not os.path.exists(self.spill):
+                    return
+                os.replace(self.spill, sending)
+        with open(sending) as f:
+            items = [json.loads(line) for line in f if line.strip()]
+        self.logger.info("Sending {} spilled items from {}".format(len(items), self.spill))
+        ok = True
+        for i in range(0, len(items), self.batch_size):
+            batch = items[i:i + self.batch_size]
+            ok = ok and self._post(batch)
+            if not ok:
+                self._spill(batch)
+        os.remove(sending)
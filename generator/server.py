@@ -1,8 +1,14 @@
 import logging
+from chess import Board
 from chess.pgn import Game, GameNode
 from model import Puzzle
+from seen import SeenGames
+from sender import Sender
+from positions import PositionIndex, position_key
 import requests
+import metrics
 import urllib.parse
+from typing import Dict, Any, Optional
 from requests.adapters import HTTPAdapter
 from requests.packages.urllib3.util.retry import Retry
 
@@ -19,35 +25,60 @@ http.mount("http://", adapter)
 
 class Server:
 
-    def __init__(self, logger: logging.Logger, url: str, token: str, version: int) -> None:
+    # `spill` is the file where puzzles wait while the server can't take them, see Sender
+    def __init__(self, logger: logging.Logger, url: str, token: str, version: int, spill: Optional[str] = None) -> None:
         self.logger = logger
         self.url = url
         self.token = token
         self.version = version
+        self.seen: Optional[SeenGames] = None
+        # when set, is_seen_pos checks it instead of the server
+        self.positions: Optional[PositionIndex] = None
+        self.puzzles = Sender(logger, "{}/puzzle/batch?token={}".format(url, token), spill)
+        self.seen_games = Sender(logger, "{}/seen/batch?token={}".format(url, token))
+
+    # afterwards is_seen checks games locally, without the games set seen since then
+    def load_seen(self) -> None:
+        if not self.url:
+            return
+        try:
+            with metrics.timer("http"):
+                r = http.get("{}/seen/ids?token={}".format(self.url, self.token), stream = True)
+                r.raise_for_status()
+                self.seen = SeenGames(r.iter_lines(chunk_size = 1 << 16))
+            self.logger.info("Loaded {} seen games".format(len(self.seen)))
+        except Exception as e:
+            self.logger.warning("Couldn't load seen games, will request them one by one: {}".format(e))
 
     def is_seen(self, id: str) -> bool:
         if not self.url:
             return False
+        if self.seen is not None:
+            return id in self.seen
         try:
-            status = http.get(self._seen_url(id)).status_code
+            with metrics.timer("http"):
+                status = http.get(self._seen_url(id)).status_code
             return status == 200
         except Exception as e:
             self.logger.error(e)
             return False
 
     def set_seen(self, game: Game) -> None:
-        try:
-            if self.url:
-                http.post(self._seen_url(game.headers.get("Site", "?")[20:]))
-        except Exception as e:
-            self.logger.error(e)
+        if self.url:
+            self.seen_games.put(game.headers.get("Site", "?")[20:])
 
-    def is_seen_pos(self, node: GameNode) -> bool:
-        if not self.url:
+    # board is the position after node
+    def is_seen_pos(self, node: GameNode, board: Board) -> bool:
+        if self.positions is None and not self.url:
             return False
-        id = urllib.parse.quote(f"{node.parent.board().fen()}:{node.uci()}")
+        parent = board.copy(stack = 1)
+        parent.pop()
+        if self.positions is not None:
+            return position_key(parent, node.move) in self.positions
+        id = urllib.parse.quote(f"{parent.fen()}:{node.uci()}")
         try:
-            status = http.get(self._seen_url(id)).status_code
+            with metrics.timer("http"):
+                status = http.get(self._seen_url(id)).status_code
             return status == 200
         except Exception as e:
             self.logger.error(e)
@@ -57,16 +88,24 @@ class Server:
         return "{}/seen?token={}&id={}".format(self.url, self.token, id)
 
     def post(self, game_id: str, puzzle: Puzzle) -> None:
+        self.post_json(self.puzzle_json(game_id, puzzle))
+
+    def puzzle_json(self, game_id: str, puzzle: Puzzle) -> Dict[str, Any]:
         parent : GameNode = puzzle.node.parent
-        json = {
+        return {
             'game_id': game_id,
             'fen': parent.board().fen(),
             'ply': parent.ply(),
             'moves': [puzzle.node.uci()] + list(map(lambda m : m.uci(), puzzle.moves)),
             'generator_version': self.version,
         }
-        try:
-            r = http.post("{}/puzzle?token={}".format(self.url, self.token), json=json)
-            self.logger.info(r.text if r.ok else "FAILURE {}".format(r.text))
-        except Exception as e:
-            self.logger.error("Couldn't post puzzle: {}".format(e))
+
+    # queued, and posted by batches in the background
+    def post_json(self, json: Dict[str, Any]) -> None:
+        if self.url:
+            self.puzzles.put(json)
+
+    # sends what is still queued, call it once done
+    def close(self) -> None:
+        self.puzzles.close()
+        self.seen_games.close()
@@ -0,0 +1,67 @@
+import glob
+import json
+import re
+from typing import Any, BinaryIO, Dict, Iterator, List, Optional, Tuple
+from reader import open_file
+
+class Spool:
+    """
+    Puzzles written locally as NDJSON, one Server.puzzle_json payload per line, instead of
+    posted to the validator. `path` is split into numbered parts of at most `rotate` puzzles:
+    puzzles.ndjson.zst is written to puzzles.00001.ndjson.zst, puzzles.00002.ndjson.zst...
+    Numbers continue after the parts already there, so that a resumed run adds new parts.
+    A part is only created once a puzzle is written to it.
+    Paths ending with .zst are compressed with zstandard.
+    """
+
+    def __init__(self, path: str, rotate: int = 100_000) -> None:
+        self.path = path
+        self.rotate = rotate
+        self.part = max((part_number(p) for p in parts(path)), default = 0)
+        self.count = 0
+        self.file: Optional[BinaryIO] = None
+
+    def write(self, puzzle: Dict[str, Any]) -> None:
+        if self.file is None or self.count >= self.rotate:
+            self.close()
+            self.file = self._open()
+        self.file.write((json.dumps(puzzle) + "\n").encode())
+        # puzzles are few, flushing each one loses none of them when the process is killed
+        self.file.flush()
+        self.count += 1
+
+    def close(self) -> None:
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def _open(self) -> BinaryIO:
+        self.part += 1
+        self.count = 0
+        path = part_path(self.path, self.part)
+        if path.endswith(".zst"):
+            import zstandard
+            return zstandard.ZstdCompressor().stream_writer(open(path, "wb"))
+        return open(path, "wb")
+
+# puzzles.ndjson.zst -> puzzles.00001.ndjson.zst
+def part_path(path: str, number: int) -> str:
+    base, ext = split_ext(path)
+    return "{}.{:05d}{}".format(base, number, ext)
+
+def parts(path: str) -> List[str]:
+    base, ext = split_ext(path)
+    return sorted(glob.glob("{}.[0-9][0-9][0-9][0-9][0-9]{}".format(glob.escape(base), ext)))
+
+def part_number(path: str) -> int:
+    return int(re.findall(r"\.(\d{5})\.", path + ".")[-1])
+
+def split_ext(path: str) -> Tuple[str, str]:
+    i = path.find(".ndjson")
+    return (path[:i], path[i:]) if i >= 0 else (path, "")
+
+def read(path: str) -> Iterator[Dict[str, Any]]:
+    with open_file(path) as lines:
+        for line in lines:
+            if line.strip():
+                yield json.loads(line)
@@ -1,18 +1,82 @@
 import unittest
+import random
+import numpy as np
 import logging
+import os
+import shutil
 from model import Puzzle
 from generator import logger
 from server import Server
+from cassette import RecordingEngine, ReplayEngine
 from chess.engine import SimpleEngine, Mate, Cp, Score, PovScore
 from chess import Move, Color, Board, WHITE, BLACK
 from chess.pgn import Game, GameNode
 from typing import List, Optional, Tuple, Literal, Union
+from util import mate_score, win_chances
 
 import generator
 
+cassette_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "test.cassette.json")
+
+# searches are replayed from the cassette, or recorded into it when there is none yet.
+# Delete it to record it again, e.g. after changing the search limits, and commit the new one.
+# Without both, the engine tests fail rather than pass without searching anything.
+def make_test_engine() -> SimpleEngine:
+    if os.path.exists(cassette_path):
+        return ReplayEngine(cassette_path) # type: ignore
+    if shutil.which("stockfish"):
+        return RecordingEngine(generator.make_engine("stockfish", 6), cassette_path) # type: ignore
+    raise RuntimeError("{} is missing, and there is no stockfish to record it".format(cassette_path))
+
+class TestPrescreen(unittest.TestCase):
+
+    def test_has_candidate(self) -> None:
+        self.assertTrue(generator.has_candidate(
+            "1. e4 { [%eval 0.2] } 1... e5 { [%eval 0.19] } 2. Bc4 { [%eval -0.1] } 2... Qh4 { [%eval 6.5] } 3. Nf3 { [%eval -5.3] } 1-0"))
+        self.assertTrue(generator.has_candidate(
+            "1. e4 { [%eval 0.2] } 1... e5 { [%eval 0.2] } 2. Nf3 { [%eval 0.3] } 2... Nc6 { [%eval #4] } 1-0"))
+
+    def test_has_no_candidate(self) -> None:
+        self.assertFalse(generator.has_candidate(
+            "1. e4 { [%eval 0.2] } 1... e5 { [%eval 0.19] } 2. Nf3 { [%eval 0.25] } 2... Nc6 { [%eval 0.3] } 1/2-1/2"))
+        # mate in one is not a puzzle
+        self.assertFalse(generator.has_candidate(
+            "1. f3 { [%eval -0.6] } 1... e5 { [%eval -0.5] } 2. g4 { [%eval #-1] } 2... Qh4# 0-1"))
+
+    def test_candidate_plies_match_analyze_position(self) -> None:
+        rng = random.Random(1)
+        def random_eval() -> Score:
+            if rng.random() < 0.2:
+                return Mate(rng.randint(1, 25) * rng.choice([1, -1]))
+            return Cp(rng.choice([rng.randint(-1500, 1500), rng.choice([-401, -400, 399, 400, 401])]))
+        for _ in range(500):
+            self.assert_same_candidates([random_eval() for _ in range(rng.randint(1, 30))])
+        # prev_score > Cp(400) is already winning, Cp(400) isn't
+        self.assertEqual(self.assert_same_candidates([Cp(400), Mate(5)]), [1])
+        self.assertEqual(self.assert_same_candidates([Cp(401), Mate(5)]), [])
+        # a mate for black is a puzzle for black, not for white after it
+        self.assertEqual(self.assert_same_candidates([Cp(-20), Cp(30), Mate(-3), Mate(-2)]), [2])
+
+    # the plies the scalar rules of analyze_position don't reject before looking at the board,
+    # for evals from white's point of view after each ply of a game from the initial position
+    def assert_same_candidates(self, evals: List[Score]) -> List[int]:
+        expected = []
+        for i, current in enumerate(evals):
+            winner = BLACK if i % 2 == 0 else WHITE
+            score = PovScore(current, WHITE).pov(winner)
+            prev_score = PovScore(evals[i - 1], WHITE).pov(winner) if i > 0 else Cp(20)
+            if prev_score > Cp(400) or (score >= Mate(1) and not generator.allow_one_mover):
+                continue
+            if score > generator.mate_soon or (score >= Cp(0) and win_chances(score) > win_chances(prev_score) + 0.5):
+                expected.append(i)
+        scores = np.array([e.score(mate_score = mate_score) for e in evals])
+        self.assertEqual(generator.candidate_plies(scores, BLACK).tolist(), expected, evals)
+        return expected
+
+
 class TestGenerator(unittest.TestCase):
 
-    engine = generator.make_engine("stockfish", 6)
+    engine: SimpleEngine
     server = Server(logger, "", "", 0)
     logger.setLevel(logging.DEBUG)
 
@@ -159,6 +223,10 @@ class TestGenerator(unittest.TestCase):
             self.assertEqual(puzzle.moves, moves)
 
 
+    @classmethod
+    def setUpClass(cls) -> None:
+        cls.engine = make_test_engine()
+
     @classmethod
     def tearDownClass(cls) -> None:
         cls.engine.close()
@@ -0,0 +1,349 @@
+# tests which run without an engine
+import unittest
+import json
+import logging
+import os
+import random
+import tempfile
+import chess.engine
+from chess import Board, Move
+from chess.engine import Cp, Mate, PovScore
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from threading import Thread
+from typing import Any, Dict, List, Optional, Tuple
+
+import cassette
+import seen
+import spool
+import sender
+import checkpoint
+import index
+import reader
+import util
+import replay
+from cache import AnalysisCache, CacheMiss, CacheOnlyEngine
+
+class TestCassette(unittest.TestCase):
+
+    def test_replay(self) -> None:
+        board = Board("r1bqkbnr/pppp1ppp/2n5/4p3/2B1P3/5Q2/PPPP1PPP/RNB1K1NR w KQkq - 2 3")
+        limit = chess.engine.Limit(nodes = 1000)
+        infos = [
+            { "pv": [Move.from_uci("f3f7")], "score": PovScore(Mate(1), board.turn), "depth": 1 },
+            { "pv": [Move.from_uci("c4f7"), Move.from_uci("e8f7")], "score": PovScore(Cp(-200), board.turn), "depth": 1 },
+        ]
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "cassette.json")
+            with open(path, "w") as f:
+                json.dump({ "id": { "name": "test" }, "searches": {
+                    cassette.key(board, limit, 2, None): [cassette.dump_info(info) for info in infos]
+                }}, f)
+            engine = cassette.ReplayEngine(path)
+        self.assertEqual(engine.id["name"], "test")
+        self.assertEqual(engine.analyse(board, limit, multipv = 2), infos)
+        with self.assertRaises(cassette.CassetteMiss):
+            engine.analyse(board, limit, multipv = 1)
+        with self.assertRaises(cassette.CassetteMiss):
+            engine.analyse(board, limit, multipv = 2, root_moves = [Move.from_uci("c4f7")])
+
+    def test_key_ignores_root_moves_order(self) -> None:
+        board, limit = Board(), chess.engine.Limit(nodes = 1)
+        moves = [Move.from_uci("e2e4"), Move.from_uci("d2d4")]
+        self.assertEqual(cassette.key(board, limit, 1, moves), cassette.key(board, limit, 1, moves[::-1]))
+        self.assertNotEqual(cassette.key(board, limit, 1, moves), cassette.key(board, limit, 1, None))
+
+class TestReplay(unittest.TestCase):
+
+    def test_diff(self) -> None:
+        def puzzle(game_id: str, moves: str) -> Dict[str, Any]:
+            return { "game_id": game_id, "fen": "fen", "moves": moves.split() }
+        before = { p["game_id"]: p for p in [puzzle("kept", "e2e4 e7e5"), puzzle("lost", "d2d4"), puzzle("moved", "g1f3 g8f6")] }
+        after = { p["game_id"]: p for p in [puzzle("kept", "e2e4 e7e5"), puzzle("gained", "c2c4"), puzzle("moved", "g1f3 d7d5")] }
+        changes = [(change, p["game_id"]) for change, p in replay.diff(before, after)]
+        self.assertEqual(sorted(changes), [("changed", "moved"), ("gained", "gained"), ("lost", "lost")])
+
+    def test_cache_only(self) -> None:
+        board, limit = Board(), chess.engine.Limit(nodes = 1000)
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = AnalysisCache(os.path.join(tmp, "cache.sqlite"), "test")
+            cache.put(board, 2, limit, [(Move.from_uci("e2e4"), Cp(30)), (Move.from_uci("d2d4"), Cp(20))])
+            self.assertEqual(cache.engines(), ["test"])
+            engine = CacheOnlyEngine("test")
+            pair = util.get_next_move_pair(engine, board, board.turn, limit, cache) # type: ignore
+            self.assertEqual(pair.best.move, Move.from_uci("e2e4"))
+            with self.assertRaises(CacheMiss):
+                util.get_next_move_pair(engine, board, board.turn, chess.engine.Limit(nodes = 2000), cache) # type: ignore
+            cache.close()
+
+def write_games(path: str, count: int) -> List[str]:
+    sites = ["https://lichess.org/{:08d}".format(i) for i in range(count)]
+    text = "".join('[Event "Rated Blitz game"]\n[Site "{}"]\n\n{} 1-0\n\n'.format(site, "1. e4 e5 " * (i % 7)) for i, site in enumerate(sites))
+    if path.endswith(".zst"):
+        import zstandard
+        with open(path, "wb") as f:
+            f.write(zstandard.ZstdCompressor().compress(text.encode()))
+    else:
+        with open(path, "w") as f:
+            f.write(text)
+    return sites
+
+def read_sites(path: str, start: int = 0, end: Optional[int] = None) -> List[str]:
+    with reader.open_file(path, start, end, align = True) as lines:
+        return [line.split('"')[1] for line in lines if line.startswith("[Site ")]
+
+class TestShards(unittest.TestCase):
+
+    def test_shards_read_every_game_once(self) -> None:
+        with tempfile.TemporaryDirectory() as tmp:
+            for name in ["games.pgn", "games.pgn.zst"]:
+                path = os.path.join(tmp, name)
+                sites = write_games(path, 50)
+                if name.endswith(".zst"):
+                    with self.assertRaises(ValueError):
+                        index.shard_range(path, 1, 2)
+                    index.build(path, stride = 10)
+                for n in range(1, 8):
+                    ranges = [index.shard_range(path, i, n) for i in range(1, n + 1)]
+                    self.assertEqual(ranges[0][0], 0)
+                    self.assertEqual([r[1] for r in ranges[:-1]], [r[0] for r in ranges[1:]])
+                    read = [site for start, end in ranges for site in read_sites(path, start, end)]
+                    self.assertEqual(read, sites, (name, n))
+
+    def test_shard_starting_on_a_game(self) -> None:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "games.pgn")
+            sites = write_games(path, 10)
+            with open(path) as f:
+                text = f.read()
+            third = [i for i in range(len(text)) if text.startswith("[Event ", i)][2]
+            self.assertEqual(read_sites(path, 0, third), sites[:2])
+            self.assertEqual(read_sites(path, third), sites[2:])
+            self.assertEqual(read_sites(path, third + 1), sites[3:])
+            self.assertEqual(read_sites(path, third - 1), sites[2:])
+
+    def test_index_seek(self) -> None:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "games.pgn.zst")
+            write_games(path, 25)
+            game_index = index.build(path, stride = 10)
+            self.assertEqual(game_index.games, 25)
+            self.assertEqual(len(game_index.offsets), 3)
+            self.assertEqual(index.load(path), game_index)
+            game, offset = game_index.seek(17)
+            self.assertEqual(game, 10)
+            self.assertEqual(read_sites(path, offset)[0], "https://lichess.org/00000010")
+            self.assertEqual(game_index.seek(99)[0], 20)
+
+class TestCheckpoint(unittest.TestCase):
+
+    def test_save_resumes_from_the_earliest_pending_game(self) -> None:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "checkpoint.json")
+            c = checkpoint.Checkpoint(path, checkpoint.Progress("games.pgn", 0, 0, 0))
+            for game, offset in enumerate([100, 250, 400]):
+                c.read(offset, game)
+                c.start(game)
+            c.read(600, 3)
+            # games finish out of order
+            c.finish(1, 1)
+            c.save()
+            self.assertEqual(checkpoint.load(path), checkpoint.Progress("games.pgn", 100, 0, 1))
+            c.finish(0, 0)
+            c.save()
+            self.assertEqual(checkpoint.load(path), checkpoint.Progress("games.pgn", 400, 2, 1))
+            c.finish(2, 1)
+            c.save()
+            # nothing pending: the game being read
+            self.assertEqual(checkpoint.load(path), checkpoint.Progress("games.pgn", 600, 3, 2))
+
+    def test_tick(self) -> None:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "checkpoint.json")
+            c = checkpoint.Checkpoint(path, checkpoint.Progress("games.pgn", 0, 0, 0), interval = 60)
+            self.assertFalse(c.tick())
+            self.assertIsNone(checkpoint.load(path))
+            c.interval = -1
+            self.assertTrue(c.tick())
+            self.assertIsNotNone(checkpoint.load(path))
+
+class BatchServer(HTTPServer):
+    """
+    Local server keeping the batches posted to it, or failing them with a 400,
+    which the senders don't retry, while `failing`
+    """
+
+    def __init__(self) -> None:
+        self.batches: List[List[Any]] = []
+        self.failing = False
+        server = self
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self) -> None:
+                batch = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                if not server.failing:
+                    server.batches.append(batch)
+                self.send_response(400 if server.failing else 200)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+            def log_message(self, *args: Any) -> None:
+                pass
+        super().__init__(("127.0.0.1", 0), Handler)
+        Thread(target = self.serve_forever, daemon = True).start()
+
+    def url(self) -> str:
+        return "http://127.0.0.1:{}/puzzle/batch?token=".format(self.server_address[1])
+
+class TestSender(unittest.TestCase):
+
+    logger = logging.getLogger("testSender")
+    logger.setLevel(logging.CRITICAL)
+
+    def test_spill_and_resend(self) -> None:
+        server = BatchServer()
+        with tempfile.TemporaryDirectory() as tmp:
+            spill = os.path.join(tmp, "spill.ndjson")
+            server.failing = True
+            s = sender.Sender(self.logger, server.url(), spill, batch_size = 2, delay = 0.01)
+            for i in range(3):
+                s.put({ "id": i })
+            s.close()
+            with open(spill) as f:
+                self.assertEqual([json.loads(line)["id"] for line in f], [0, 1, 2])
+            # still failing on the next run: spilled items are kept
+            s = sender.Sender(self.logger, server.url(), spill, batch_size = 2, delay = 0.01)
+            s.put({ "id": 3 })
+            s.close()
+            with open(spill) as f:
+                self.assertEqual(sorted(json.loads(line)["id"] for line in f), [0, 1, 2, 3])
+            server.failing = False
+            s = sender.Sender(self.logger, server.url(), spill, batch_size = 2, delay = 0.01)
+            s.put({ "id": 4 })
+            s.close()
+            self.assertTrue(all(len(batch) <= 2 for batch in server.batches))
+            self.assertEqual(sorted(item["id"] for batch in server.batches for item in batch), [0, 1, 2, 3, 4])
+            self.assertFalse(os.path.exists(spill))
+            self.assertFalse(os.path.exists(spill + ".sending"))
+        server.shutdown()
+
+    def test_full_queue_spills(self) -> None:
+        server = BatchServer()
+        with tempfile.TemporaryDirectory() as tmp:
+            spill = os.path.join(tmp, "spill.ndjson")
+            s = sender.Sender(self.logger, server.url(), spill, queue_size = 1)
+            # the thread isn't running yet, so the queue stays full
+            s.thread = Thread()
+            s.put({ "id": 0 })
+            s.put({ "id": 1 })
+            with open(spill) as f:
+                self.assertEqual([json.loads(line)["id"] for line in f], [1])
+        server.shutdown()
+
+class FakeTablebase:
+    """
+    Stands for a chess.syzygy.Tablebase in tests: WDL and DTZ by position, for the side to move
+    """
+
+    def __init__(self, results: Dict[str, Tuple[int, int]]) -> None:
+        self.results = results
+
+    def get_wdl(self, board: Board) -> Optional[int]:
+        return self.results[board.epd()][0] if board.epd() in self.results else None
+
+    def get_dtz(self, board: Board) -> Optional[int]:
+        return self.results[board.epd()][1] if board.epd() in self.results else None
+
+class TestTablebase(unittest.TestCase):
+
+    board = Board("7k/8/6K1/8/8/8/8/Q7 w - - 0 1")
+
+    def tablebase(self, after: Dict[str, Tuple[int, int]]) -> FakeTablebase:
+        results = { util.pushed(self.board, move).epd(): (-2, -20) for move in self.board.legal_moves }
+        results.update({ util.pushed(self.board, Move.from_uci(uci)).epd(): result for uci, result in after.items() })
+        results[self.board.epd()] = (2, 1)
+        return FakeTablebase(results)
+
+    def test_scores(self) -> None:
+        tablebase = self.tablebase({
+            "a1a2": (-2, -5), # win, the opponent to move loses
+            "a1b1": (-2, -11),
+            "a1c3": (-1, -101), # cursed win
+            "a1d4": (0, 0),
+            "g6f6": (1, 101), # blessed loss
+            "g6f5": (2, 3), # loss
+        })
+        lines = dict(util.tablebase_lines(tablebase, self.board) or []) # type: ignore
+        self.assertEqual(len(lines), self.board.legal_moves.count())
+        self.assertEqual(lines[Move.from_uci("a1a8")], Mate(1))
+        self.assertEqual(lines[Move.from_uci("a1g7")], Mate(1))
+        self.assertEqual(lines[Move.from_uci("a1a2")], Cp(util.tablebase_win - 6))
+        self.assertEqual(lines[Move.from_uci("a1b1")], Cp(util.tablebase_win - 12))
+        self.assertEqual(lines[Move.from_uci("a1c3")], Cp(0))
+        self.assertEqual(lines[Move.from_uci("a1d4")], Cp(0))
+        self.assertEqual(lines[Move.from_uci("g6f6")], Cp(0))
+        self.assertEqual(lines[Move.from_uci("g6f5")], Cp(-util.tablebase_win + 4))
+
+    def test_ranking(self) -> None:
+        tablebase = self.tablebase({ "a1a2": (-2, -5), "g6f5": (2, 3) })
+        lines = util.tablebase_lines(tablebase, self.board) # type: ignore
+        assert lines is not None
+        # both mates, then the shortest win
+        self.assertEqual(sorted(move.uci() for move, _ in lines[:2]), ["a1a8", "a1g7"])
+        self.assertEqual(lines[2][0], Move.from_uci("a1a2"))
+        self.assertEqual(lines[-1][0], Move.from_uci("g6f5"))
+        pair = util.get_next_move_pair(None, self.board, self.board.turn, chess.engine.Limit(nodes = 1), tablebase = tablebase) # type: ignore
+        self.assertEqual(pair.best.score, Mate(1))
+        self.assertEqual(pair.second.score if pair.second else None, Mate(1))
+
+    def test_not_in_tablebase(self) -> None:
+        self.assertIsNone(util.tablebase_lines(FakeTablebase({}), self.board)) # type: ignore
+        tablebase = self.tablebase({})
+        del tablebase.results[util.pushed(self.board, Move.from_uci("a1a2")).epd()]
+        self.assertIsNone(util.tablebase_lines(tablebase, self.board)) # type: ignore
+
+class TestSeen(unittest.TestCase):
+
+    def test_pack(self) -> None:
+        packed, others = seen.pack([b"00000000", b"00000001", b"00000010", b"ZZZZZZZZ", b"abcd-fgh", b"abcdefghijkl", b"short"])
+        self.assertEqual(packed.tolist(), [0, 1, 62, 62 ** 8 - 1])
+        self.assertLess(62 ** 8, 1 << 48)
+        self.assertEqual(others, [b"abcdefghijkl", b"short", b"abcd-fgh"])
+        packed, others = seen.pack([])
+        self.assertEqual((len(packed), others), (0, []))
+
+    def test_contains(self) -> None:
+        rng = random.Random(1)
+        def random_id() -> str:
+            return "".join(rng.choice(seen.alphabet.decode()) for _ in range(8))
+        # more than one chunk
+        ids = { random_id() for _ in range(70_000) }
+        unseen = { random_id() for _ in range(1000) } - ids
+        others = ["abcdefghijkl", "abc_defg"]
+        lines = [id.encode() for id in sorted(ids) + others + sorted(ids)[:10]] + [b""]
+        games = seen.SeenGames(lines)
+        self.assertEqual(len(games), len(ids) + len(others))
+        self.assertTrue(all(id in games for id in rng.sample(sorted(ids), 2000)))
+        self.assertFalse(any(id in games for id in unseen))
+        self.assertTrue(all(id in games for id in others))
+        self.assertFalse("abcdefghijkm" in games)
+        self.assertFalse("short" in games)
+        self.assertFalse("00000000" in seen.SeenGames([]))
+
+class TestSpool(unittest.TestCase):
+
+    def test_parts(self) -> None:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "puzzles.ndjson.zst")
+            # a run without puzzles leaves no part behind
+            spool.Spool(path).close()
+            self.assertEqual(spool.parts(path), [])
+            for run in range(2):
+                s = spool.Spool(path, rotate = 2)
+                for i in range(3):
+                    s.write({ "run": run, "i": i })
+                s.close()
+            parts = spool.parts(path)
+            self.assertEqual([os.path.basename(part) for part in parts], ["puzzles.0000{}.ndjson.zst".format(i) for i in range(1, 5)])
+            self.assertEqual([[p["i"] for p in spool.read(part)] for part in parts], [[0, 1], [2], [0, 1], [2]])
+
+
+if __name__ == '__main__':
+    unittest.main()
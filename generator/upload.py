@@ -0,0 +1,88 @@
+import argparse
+import logging
+import random
+from datetime import datetime
+from typing import Any, Dict, Iterator, List
+import spool
+from server import http
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(format='%(asctime)s %(levelname)-4s %(message)s', datefmt='%m/%d %H:%M')
+logger.setLevel(logging.INFO)
+
+id_chars = "0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ"
+
+# same as the validator's randomId
+def random_id() -> str:
+    return "".join(random.choice(id_chars) for _ in range(5))
+
+def batches(files: List[str], size: int) -> Iterator[List[Dict[str, Any]]]:
+    batch = []
+    for file in files:
+        for puzzle in spool.read(file):
+            batch.append(puzzle)
+            if len(batch) >= size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+# returns the count of puzzles created
+def upload_http(url: str, token: str, batch: List[Dict[str, Any]]) -> int:
+    r = http.post("{}/puzzle/batch?token={}".format(url, token), json = batch)
+    r.raise_for_status()
+    return sum(1 for line in r.text.split("\n") if line.startswith("Created"))
+
+# same document as the validator's /puzzle route
+def upload_mongo(coll: Any, batch: List[Dict[str, Any]]) -> int:
+    import pymongo.errors
+    docs = [{
+        "_id": random_id(),
+        "gameId": p["game_id"],
+        "fen": p["fen"],
+        "ply": p["ply"],
+        "moves": p["moves"],
+        "generator": p["generator_version"],
+        "createdAt": datetime.utcnow(),
+    } for p in batch]
+    created = 0
+    while docs:
+        try:
+            return created + len(coll.insert_many(docs, ordered = False).inserted_ids)
+        except pymongo.errors.BulkWriteError as e:
+            errors = e.details["writeErrors"]
+            created += len(docs) - len(errors)
+            retry = []
+            for error in errors:
+                if error["code"] == 11000 and is_id_collision(error):
+                    doc = docs[error["index"]]
+                    doc["_id"] = random_id()
+                    retry.append(doc)
+                elif error["code"] != 11000:
+                    logger.warning("Mongo insert error: {}".format(error["errmsg"]))
+            docs = retry
+    return created
+
+# the random id of another puzzle, rather than a game already in the puzzle DB
+def is_id_collision(error: Dict[str, Any]) -> bool:
+    # servers before 4.4 only tell the index in the message
+    return "_id" in error.get("keyPattern", {}) or " index: _id_ " in error.get("errmsg", "")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='upload.py', description='uploads puzzles spooled by generator.py --out to the validator, or straight to its mongodb')
+    parser.add_argument("files", help="spool files, e.g. puzzles.*.ndjson.zst", nargs="+", metavar="FILE.ndjson")
+    parser.add_argument("--url", "-u", help="URL of the validator", default="http://localhost:8000")
+    parser.add_argument("--token", help="Server secret token", default="changeme")
+    parser.add_argument("--mongo", help="insert into this mongodb instead of posting to the validator", metavar="mongodb://HOST:PORT")
+    parser.add_argument("--db", help="mongodb database of the validator", default="puzzler")
+    parser.add_argument("--batch", help="count of puzzles sent at once", type=int, default=1000)
+    args = parser.parse_args()
+    coll = None
+    if args.mongo:
+        import pymongo
+        coll = pymongo.MongoClient(args.mongo)[args.db]["puzzle2"]
+    sent, created = 0, 0
+    for batch in batches(args.files, args.batch):
+        created += upload_mongo(coll, batch) if coll is not None else upload_http(args.url, args.token, batch)
+        sent += len(batch)
+        logger.info("{} puzzles sent, {} created, {} skipped".format(sent, created, sent - created))
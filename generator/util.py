@@ -1,11 +1,16 @@
 from dataclasses import dataclass
 import math
+import numpy as np
 import chess
+import chess.pgn
+import chess.syzygy
 from model import EngineMove, NextMovePair
+from cache import AnalysisCache
+import metrics
 from chess import Move, Color, Board
 from chess.pgn import GameNode
-from chess.engine import SimpleEngine, Mate, Cp, Score, PovScore
-from typing import List, Optional, Tuple, Literal, Union
+from chess.engine import SimpleEngine, Mate, Cp, Score, PovScore, InfoDict
+from typing import List, Optional, Tuple, Literal, Union, Callable
 
 
 def material_count(board: Board, side: Color) -> int:
@@ -19,12 +24,98 @@ def is_up_in_material(board: Board, side: Color) -> bool:
     return material_diff(board, side) > 0
 
 
-def get_next_move_pair(engine: SimpleEngine, node: GameNode, winner: Color, limit: chess.engine.Limit) -> NextMovePair:
-    info = engine.analyse(node.board(), multipv = 2, limit = limit)
-    # print(info)
-    best = EngineMove(info[0]["pv"][0], info[0]["score"].pov(winner))
-    second = EngineMove(info[1]["pv"][0], info[1]["score"].pov(winner)) if len(info) > 1 else None
-    return NextMovePair(node, best, second)
+def pushed(board: Board, move: Move) -> Board:
+    board = board.copy()
+    board.push(move)
+    return board
+
+def get_next_move_pair(engine: SimpleEngine, board: Board, winner: Color, limit: chess.engine.Limit, cache: Optional[AnalysisCache] = None, decided: Optional[Callable[[int, NextMovePair], bool]] = None, tag: str = "", multipv: int = 2, tablebase: Optional[chess.syzygy.Tablebase] = None, root_moves: Optional[List[Move]] = None) -> NextMovePair:
+    """
+    With `decided`, the search streams its results and stops as soon as `decided(depth, pair)`
+    holds for a completed depth. `tag` tells such searches apart in the cache,
+    and must also tell apart searches restricted to `root_moves`.
+    Positions found in `tablebase` are not searched.
+    """
+    lines = tablebase_lines(tablebase, board) if tablebase else None
+    if lines is not None:
+        metrics.count("tablebase_hits")
+        return next_move_pair(board, winner, lines[:multipv])
+    lines = cache.get(board, multipv, limit, tag) if cache else None
+    if lines is None:
+        with metrics.timer("engine"):
+            if decided is None:
+                info = engine.analyse(board, multipv = multipv, limit = limit, root_moves = root_moves)
+            else:
+                info = analyse_until(engine, board, winner, limit, decided)
+        metrics.count("engine_nodes", info[0].get("nodes", 0) if info else 0)
+        # print(info)
+        lines = [(i["pv"][0], i["score"].relative) for i in info]
+        if cache:
+            cache.put(board, multipv, limit, lines, tag)
+    else:
+        metrics.count("cache_hits")
+    return next_move_pair(board, winner, lines)
+
+def get_mate_move_pair(engine: SimpleEngine, board: Board, winner: Color, limit: chess.engine.Limit, cache: Optional[AnalysisCache] = None) -> NextMovePair:
+    """
+    Stockfish only stops a search with a mate limit once its last PV mates within the limit,
+    which the second best move of a puzzle doesn't. So the mate is proven with a single PV,
+    and the other moves are searched apart, to the same limit a second PV would have had,
+    so that is_valid_attack judges the same second move.
+    """
+    pair = get_next_move_pair(engine, board, winner, limit, cache, multipv = 1)
+    others = [move for move in board.legal_moves if move != pair.best.move]
+    if not others:
+        return pair
+    second = get_next_move_pair(engine, board, winner, limit, cache, multipv = 1,
+            tag = " without {}".format(pair.best.move.uci()), root_moves = others)
+    return NextMovePair(board, pair.best, second.best)
+
+def next_move_pair(board: Board, winner: Color, lines: List[Tuple[Move, Score]]) -> NextMovePair:
+    best = EngineMove(lines[0][0], PovScore(lines[0][1], board.turn).pov(winner))
+    second = EngineMove(lines[1][0], PovScore(lines[1][1], board.turn).pov(winner)) if len(lines) > 1 else None
+    return NextMovePair(board, best, second)
+
+# score of tablebase wins, in the range engines use for them, minus the plies to the next zeroing move
+tablebase_win = 20_000
+
+def tablebase_lines(tablebase: chess.syzygy.Tablebase, board: Board) -> Optional[List[Tuple[Move, Score]]]:
+    """
+    All moves ranked by their tablebase result, as scores relative to the side to move,
+    or None if the position isn't in the tablebase.
+    Tablebases don't know mate distances, so only checkmating moves score as mates.
+    """
+    if tablebase.get_wdl(board) is None:
+        return None
+    lines: List[Tuple[Move, Score]] = []
+    for move in board.legal_moves:
+        after = pushed(board, move)
+        if after.is_checkmate():
+            lines.append((move, Mate(1)))
+            continue
+        wdl = tablebase.get_wdl(after)
+        dtz = tablebase.get_dtz(after)
+        if wdl is None or dtz is None:
+            return None
+        # cursed wins and blessed losses are draws by the 50 move rule
+        if wdl < -1:
+            lines.append((move, Cp(tablebase_win - abs(dtz) - 1)))
+        elif wdl > 1:
+            lines.append((move, Cp(-tablebase_win + abs(dtz) + 1)))
+        else:
+            lines.append((move, Cp(0)))
+    lines.sort(key = lambda line: line[1], reverse = True)
+    return lines
+
+def analyse_until(engine: SimpleEngine, board: Board, winner: Color, limit: chess.engine.Limit, decided: Callable[[int, NextMovePair], bool]) -> List[InfoDict]:
+    with engine.analysis(board, limit, multipv = 2) as analysis:
+        for info in analysis:
+            # the second line closes a depth
+            if info.get("multipv") == 2 and "pv" in info and "score" in info:
+                pair = next_move_pair(board, winner, [(i["pv"][0], i["score"].relative) for i in analysis.multipv])
+                if decided(info.get("depth", 0), pair):
+                    break
+        return analysis.multipv
 
 def win_chances(score: Score) -> float:
     """
@@ -37,6 +128,27 @@ def win_chances(score: Score) -> float:
     cp = score.score()
     return 2 / (1 + math.exp(-0.004 * cp)) - 1 if cp is not None else 0
 
+# scale of mate scores, as in Score.score(mate_score = mate_score)
+mate_score = 1_000_000
+
+def read_evals(movetext: str) -> np.ndarray:
+    """
+    `[%eval ...]` annotations of a single line of movetext, from white's point of view,
+    parsed like chess.pgn.GameNode.eval() does
+    """
+    return np.array([
+        Mate(int(mate)).score(mate_score = mate_score) if mate else int(float(cp) * 100)
+        for mate, cp in chess.pgn.EVAL_REGEX.findall(movetext)
+    ], dtype = np.int64)
+
+def win_chances_array(scores: np.ndarray) -> np.ndarray:
+    """
+    win_chances of many scores in the mate_score scale
+    """
+    mate = np.abs(scores) > mate_score // 2
+    cp = np.clip(scores, -10_000, 10_000)
+    return np.where(mate, (scores > 0).astype(float), 2 / (1 + np.exp(-0.004 * cp)) - 1)
+
 def exclude_time_control(line: str) -> bool:
     if not line.startswith("[TimeControl "):
         return False
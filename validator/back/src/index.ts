@@ -11,7 +11,8 @@ Env.make().then((env: Env) => {
 
   app.use(express.static('public'));
 
-  app.use(bodyParser.json());
+  // puzzles are uploaded by batches of 1000, see generator/upload.py
+  app.use(bodyParser.json({ limit: '10mb' }));
 
   app.use(cookieSession({
     name: 'session',
@@ -1,4 +1,4 @@
-import { Collection, Db, UpdateWriteOpResult } from 'mongodb';
+import { Collection, Cursor, Db, UpdateWriteOpResult } from 'mongodb';
 import { Token } from 'simple-oauth2';
 import { Puzzle, Review } from './puzzle';
 import * as crypto from "crypto";
@@ -25,6 +25,8 @@ export class PuzzleMongo {
 
   constructor(readonly coll: Collection) {
     this.coll.createIndex({ gameId: 1 }, { unique: true });
+    // SeenMongo.positionExists
+    this.coll.createIndex({ fen: 1, 'moves.0': 1 });
   }
 
   get = (id: string): Promise<Puzzle | null> =>
@@ -97,4 +99,10 @@ export class SeenMongo {
     this.puzzleColl.countDocuments({ fen: fen, 'moves.0': move }).then(n => n > 0);
 
   set = (id: string) => this.seenColl.insertOne({_id: id}).catch(() => {});
+
+  // unordered, so that ids already seen don't stop the others from being inserted
+  setMany = (ids: string[]) =>
+    ids.length ? this.seenColl.insertMany(ids.map(id => ({_id: id})), { ordered: false }).catch(() => {}) : Promise.resolve();
+
+  ids = (): Cursor<{_id: string}> => this.seenColl.find({}, { projection: { _id: 1 } });
 }
@@ -4,6 +4,7 @@ import * as oauth from './oauth';
 import { Puzzle, randomId } from './puzzle';
 import { Response as ExResponse } from 'express';
 import { config } from './config';
+import { once } from 'events';
 
 type HttpResponse = ExResponse<string>
 
@@ -55,31 +56,45 @@ export default function(app: Express.Express, env: Env) {
   });
 
   let duplicates = 0;
-  app.post('/puzzle', async (req, res) => {
-    if (req.query.token as string != config.generatorToken)
-      return res.status(400).send('Wrong token');
+  const insertPuzzle = async (body: any, ip: string): Promise<string> => {
     const puzzle: Puzzle = {
       _id: randomId(),
-      gameId: req.body.game_id,
-      fen: req.body.fen,
-      ply: req.body.ply,
-      moves: req.body.moves,
-      generator: req.body.generator_version,
+      gameId: body.game_id,
+      fen: body.fen,
+      ply: body.ply,
+      moves: body.moves,
+      generator: body.generator_version,
       createdAt: new Date(),
-      ip: req.ip
+      ip
     };
     try {
       await env.mongo.puzzle.insert(puzzle);
-      return res.send(`Created ${config.http.url}/puzzle/${puzzle._id}`);
+      return `Created ${config.http.url}/puzzle/${puzzle._id}`;
     } catch (e) {
+      // the random id of another puzzle, rather than a game already in the puzzle DB
+      if (e.code == 11000 && (e.keyPattern?._id || `${e.message}`.includes(' index: _id_ ')))
+        return insertPuzzle(body, ip);
       const msg = e.code == 11000 ? `Game ${puzzle.gameId} already in the puzzle DB!` : e.message;
       if (e.code == 11000) {
         duplicates++;
         console.info(`${duplicates} duplicates detected.`);
       } else 
         console.warn(`Mongo insert error: ${msg}`);
-      return res.status(200).send(msg);
+      return msg;
     }
+  };
+  app.post('/puzzle', async (req, res) => {
+    if (req.query.token as string != config.generatorToken)
+      return res.status(400).send('Wrong token');
+    return res.status(200).send(await insertPuzzle(req.body, req.ip));
+  });
+  // one message per puzzle, one per line
+  app.post('/puzzle/batch', async (req, res) => {
+    if (req.query.token as string != config.generatorToken)
+      return res.status(400).send('Wrong token');
+    const messages: string[] = [];
+    for (const body of req.body as any[]) messages.push(await insertPuzzle(body, req.ip));
+    return res.status(200).send(messages.join('\n'));
   });
 
   app.get('/seen', async (req, res) => {
@@ -100,6 +115,27 @@ export default function(app: Express.Express, env: Env) {
     env.mongo.seen.set(req.query.id as string);
     return res.status(201).send();
   });
+  // every seen game id, one per line, for the generator to check locally
+  app.get('/seen/ids', async (req, res) => {
+    if (req.query.token as string != config.generatorToken)
+      return res.status(400).send('Wrong token');
+    res.type('text/plain');
+    let lines = '';
+    for await (const doc of env.mongo.seen.ids()) {
+      lines += doc._id + '\n';
+      if (lines.length > 65536) {
+        if (!res.write(lines)) await once(res, 'drain');
+        lines = '';
+      }
+    }
+    return res.end(lines);
+  });
+  app.post('/seen/batch', async (req, res) => {
+    if (req.query.token as string != config.generatorToken)
+      return res.status(400).send('Wrong token');
+    await env.mongo.seen.setMany(req.body as string[]);
+    return res.status(201).send();
+  });
 
   app.get('/logout', (req, res) => {
     req.session!.authId = '';